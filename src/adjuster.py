@@ -1,27 +1,135 @@
-import os
+import os, re, argparse
 from string import Template
 from helper import AzureOpenAI, GenericTools
+from manifest import Manifest
+from telemetry import Telemetry
 import prompts as prt
 
+# Speaker turns start with the labels written by the transcriber (Speaker Guest-1:)
+SPEAKER_TURN = re.compile(r'^\s*Speaker\s+[\w-]+\s*:', re.IGNORECASE)
+
 class TranscriptionAdjuster:
-    def __init__(self, folder):
+    def __init__(self, folder, max_workers=None):
         self.folder_source = folder
         self.folder_adjusted = self.folder_source.replace(self.folder_source.split('/')[-1:][0], 'adjusted')
         self.user_prompt = prt.user_prompt_transcription_adjuster       
+        self.azure_openai = AzureOpenAI()
+        self.max_workers = max_workers or self.azure_openai.max_concurrency
+        self.manifest = Manifest(f"{os.path.dirname(self.folder_adjusted) or '.'}/manifest.jsonl")
+        # Transcriptions longer than window_tokens are adjusted in windows of speaker turns (0 disables windows)
+        self.window_tokens = int(os.getenv("AZURE_OPENAI_ADJUSTMENT_WINDOW_TOKENS", "3000"))
+        self.context_turns = int(os.getenv("AZURE_OPENAI_ADJUSTMENT_CONTEXT_TURNS", "2"))
+        # A new model, prompt or window size invalidates every adjusted transcription
+        self.config = Manifest.fingerprint(self.azure_openai.model, prt.system_prompt_transcription_adjuster, self.user_prompt,
+                                           prt.system_prompt_transcription_adjuster_window, 
+                                           prt.user_prompt_transcription_adjuster_window, 
+                                           self.window_tokens, self.context_turns)
 
-    def adjust_transcriptions(self):
+    def adjust_transcriptions(self, force=False):
 
         generic_tools = GenericTools()
         
         generic_tools.create_folder(self.folder_adjusted)        
-        generic_tools.clean_folder(self.folder_adjusted)
+        if force:
+            generic_tools.clean_folder(self.folder_adjusted)
+
+        files = sorted(file for file in os.listdir(self.folder_source) if file.endswith(".txt"))
+        self.remove_orphan_adjustments(files)
+
+        with Telemetry.get().stage('adjust'):
+            jobs = [job for job in (self._plan_file(file, force) for file in files) if job]
+            # Windows of every file share one pool: a long call takes about as long as its slowest window
+            windows = [(job, index) for job in jobs for index in range(len(job["windows"]))]
+            results = generic_tools.iter_concurrently(lambda window: self._adjust_window(*window), windows, self.max_workers)
+            for (job, index), result in zip(windows, results):
+                job["results"][index] = result
+                if index == len(job["windows"]) - 1:
+                    self._complete_job(job)
+        print(f"Adjusted {len(jobs)} of {len(files)} transcriptions in {len(windows)} requests (the rest are up to date)")
+
+    def adjust_file(self, file, force=False, max_workers=None):
+        # Adjusts a single transcription, its windows concurrently unless max_workers is 1; False when it was up to date
+        job = self._plan_file(file, force)
+        if job is None:
+            return False
+        max_workers = max_workers or self.max_workers
+        if max_workers == 1 or len(job["windows"]) == 1:
+            job["results"] = [self._adjust_window(job, index) for index in range(len(job["windows"]))]
+        else:
+            job["results"] = GenericTools().run_concurrently(lambda index: self._adjust_window(job, index), 
+                                                             range(len(job["windows"])), max_workers)
+        self._complete_job(job)
+        return True
+
+    def _plan_file(self, file, force=False):
+        transcription = self._read_file(file)
+        inputs = GenericTools().hash_text(transcription)
+        if not force and self.manifest.is_current('adjustment', file, inputs, self.config):
+            return None
+
+        windows = self.split_windows(transcription)
+        return {"file": file, "inputs": inputs, "windows": windows, "results": [None] * len(windows)}
+
+    def split_windows(self, transcription):
+        # [(context, window)]: consecutive speaker turns packed up to window_tokens, each with the turns before it
+        turns = self._split_turns(transcription)
+        if not self.window_tokens or len(turns) < 2 or self.azure_openai.estimate_tokens(transcription) <= self.window_tokens:
+            return [(None, transcription)]
+
+        windows, window, window_tokens = [], [], 0
+        for turn in turns:
+            tokens = self.azure_openai.estimate_tokens(turn)
+            if window and window_tokens + tokens > self.window_tokens:
+                windows.append(window)
+                window, window_tokens = [], 0
+            window.append(turn)
+            window_tokens += tokens
+        windows.append(window)
 
-        for file in os.listdir(self.folder_source):
-            if file.endswith(".txt"):
-                transcription = self._read_file(file)
-                prompt = self._create_prompt(transcription)
-                result = self._send_request(prompt)
-                self._write_adjusted_transcription(file, result)
+        result, previous = [], []
+        for window in windows:
+            context = previous[-self.context_turns:] if self.context_turns else []
+            result.append(("".join(context).strip() or None, "".join(window).strip()))
+            previous = window
+        return result
+
+    def _split_turns(self, transcription):
+        # Lines without a speaker label belong to the turn above them
+        turns = []
+        for line in transcription.splitlines(keepends=True):
+            if turns and not SPEAKER_TURN.match(line):
+                turns[-1] += line
+            else:
+                turns.append(line)
+        return turns
+
+    def _adjust_window(self, job, index):
+        context, window = job["windows"][index]
+        if len(job["windows"]) == 1:
+            with Telemetry.get().file('adjust', job["file"]):
+                return self._send_request(self._create_prompt(window))
+
+        with Telemetry.get().file('adjust', f"{job['file']}[{index}]"):
+            return self.azure_openai.send_llm_request(prt.system_prompt_transcription_adjuster_window,
+                                                      self._create_window_prompt(context, window), return_json=False)
+
+    def _complete_job(self, job):
+        self._write_adjusted_transcription(job["file"], self._merge_windows(job["results"]))
+        self.manifest.record('adjustment', job["file"], job["inputs"], self.config, [f"{self.folder_adjusted}/{job['file']}"])
+
+    def _merge_windows(self, results):
+        if len(results) == 1:
+            return results[0]
+        return "\n".join(result.strip() for result in results)
+
+    def remove_orphan_adjustments(self, files):
+        # Drop adjusted transcriptions whose raw transcription no longer exists
+        files = set(files)
+        for key in self.manifest.keys('adjustment'):
+            if key not in files:
+                if os.path.exists(f"{self.folder_adjusted}/{key}"):
+                    os.unlink(f"{self.folder_adjusted}/{key}")
+                self.manifest.forget('adjustment', key)
 
     def _read_file(self, file):
         with open(f"{self.folder_source}/{file}", "r") as f:
@@ -31,13 +139,24 @@ class TranscriptionAdjuster:
         template = Template(self.user_prompt)
         return template.substitute(transcription=transcription)
 
+    def _create_window_prompt(self, context, window):
+        template = Template(prt.user_prompt_transcription_adjuster_window)
+        return template.substitute(context=context or "(start of the call)", transcription=window)
+
     def _send_request(self, prompt):
-        return AzureOpenAI().send_llm_request(prt.system_prompt_transcription_adjuster, prompt, return_json=False)
+        return self.azure_openai.send_llm_request(prt.system_prompt_transcription_adjuster, prompt, return_json=False)
 
     def _write_adjusted_transcription(self, file, result):
         with open(f"{self.folder_adjusted}/{file}", "w") as f:
             f.write(result)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='Clean the outputs and adjust every transcription again')
+    args = parser.parse_args()
+
     adjuster = TranscriptionAdjuster('transcriptions/raw')
-    adjuster.adjust_transcriptions()
\ No newline at end of file
+    adjuster.adjust_transcriptions(force=args.force)
+    print(f"Azure OpenAI cache: {adjuster.azure_openai.cache.stats()}")
+    print(f"Azure OpenAI throughput: {adjuster.azure_openai.scheduler_stats()}")
+    Telemetry.get().export('adjust')
\ No newline at end of file
@@ -0,0 +1,196 @@
+import os, argparse
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import gammaln
+from segments import parse_transcription_filename
+
+# Score columns of every report, and whether a higher value is better
+METRICS = {
+    'llm-similarity': ('scores-llm-{source}.csv', 'similarity-score', True),
+    'embeddings-similarity': ('scores-embeddings.csv', 'similarity-score', True),
+    'wer': ('scores-metrics-{source}.csv', 'wer', False),
+    'cer': ('scores-metrics-{source}.csv', 'cer', False)
+}
+SOURCES = ('raw', 'adjusted')
+
+def ks_2samp_batch(a, b):
+    # Two-sided two-sample Kolmogorov-Smirnov test of every row of a against the same row of b, all rows at once.
+    # The statistic is the largest gap of the running difference of the two empirical CDFs over the merged, sorted
+    # samples (in integer units of 1/(n*m), so ties and rounding are exact). For equal sample sizes (embeddings of
+    # one model) the p-value is exact, as scipy.stats.kstest; otherwise it is the Kolmogorov approximation.
+    a, b = np.atleast_2d(a), np.atleast_2d(b)
+    n, m = a.shape[1], b.shape[1]
+    values = np.concatenate([a, b], axis=1)
+    steps = np.concatenate([np.full(n, m, dtype=np.int64), np.full(m, -n, dtype=np.int64)])
+
+    order = np.argsort(values, axis=1, kind='stable')
+    ordered = np.take_along_axis(values, order, axis=1)
+    gaps = np.abs(np.cumsum(steps[order], axis=1))
+    # With ties the CDFs are only compared after the last of the tied values
+    gaps[:, :-1][ordered[:, 1:] == ordered[:, :-1]] = 0
+    distance = gaps.max(axis=1)
+    statistics = distance / (n * m)
+
+    if n == m:
+        pvalues = _prob_outside_square(n, distance // m)
+    else:
+        pvalues = stats.kstwo.sf(statistics, np.round(n * m / (n + m)))
+    return statistics, np.clip(pvalues, 0.0, 1.0)
+
+def _prob_outside_square(n, h):
+    # P(D >= h/n) for two samples of size n: 2 * sum_k (-1)^(k+1) C(2n, n-kh) / C(2n, n), vectorized over h
+    h = np.asarray(h, dtype=np.int64)
+    pvalues = np.ones(len(h))
+    positive = h > 0
+    if not positive.any():
+        return pvalues
+    h = h[positive]
+    k = np.arange(1, n // h.min() + 1)
+    terms = n - k[None, :] * h[:, None]
+    valid = terms >= 0
+    log_ratio = 2 * gammaln(n + 1) - gammaln(np.where(valid, terms, 0) + 1) - gammaln(2 * n - np.where(valid, terms, 0) + 1)
+    signs = np.where(k % 2 == 1, 1.0, -1.0)
+    pvalues[positive] = 2 * np.sum(np.where(valid, signs * np.exp(log_ratio), 0.0), axis=1)
+    return pvalues
+
+class ScoreAnalysis:
+    # Bootstrap confidence intervals and paired significance tests over the score reports of an evaluation folder
+    def __init__(self, folder_evaluations, resamples=10000, confidence=0.95, seed=0, chunk_size=2 ** 22):
+        self.folder_evaluations = folder_evaluations
+        self.resamples = resamples
+        self.confidence = confidence
+        self.random = np.random.default_rng(seed)
+        # Resampled values held in memory at once (resamples x segments)
+        self.chunk_size = chunk_size
+
+    def load_scores(self):
+        # Long table of (metric, source, service, segment, value) from every report found in the folder
+        tables = []
+        for metric, (report, column, _) in METRICS.items():
+            for source in SOURCES:
+                path = f"{self.folder_evaluations}/{report.format(source=source)}"
+                if not os.path.exists(path):
+                    continue
+                try:
+                    scores = pd.read_csv(path)
+                except pd.errors.EmptyDataError:
+                    # Reports of a run with no scores have no header either
+                    continue
+                if report == 'scores-embeddings.csv':
+                    # Files are named {source}-{transcription file}
+                    names = scores['filename'].str.split('-', n=1)
+                    scores = scores[names.str[0] == source].assign(filename=names.str[1])
+                parsed = scores['filename'].map(parse_transcription_filename)
+                tables.append(pd.DataFrame({
+                    'metric': metric,
+                    'source': source,
+                    'service': parsed.map(lambda value: value[0] if value else None),
+                    'segment': parsed.map(lambda value: value[1] if value else None),
+                    'value': pd.to_numeric(scores[column], errors='coerce')
+                }).dropna())
+        if not tables:
+            return pd.DataFrame(columns=['metric', 'source', 'service', 'segment', 'value'])
+        return pd.concat(tables, ignore_index=True)
+
+    def bootstrap_mean(self, values):
+        # Means of resamples (with replacement) of values, drawn in chunks of at most chunk_size values
+        values = np.asarray(values, dtype=np.float64)
+        means = np.empty(self.resamples)
+        rows = max(1, self.chunk_size // max(1, len(values)))
+        for start in range(0, self.resamples, rows):
+            count = min(rows, self.resamples - start)
+            means[start:start + count] = values[self.random.integers(0, len(values), size=(count, len(values)))].mean(axis=1)
+        return means
+
+    def confidence_interval(self, values):
+        means = self.bootstrap_mean(values)
+        tail = (1 - self.confidence) / 2 * 100
+        low, high = np.percentile(means, [tail, 100 - tail])
+        return float(np.mean(values)), float(low), float(high), means
+
+    def paired_test(self, a, b):
+        # Paired bootstrap of the mean difference a - b: the confidence interval and a two-sided p-value
+        # (twice the share of resampled means on the other side of zero)
+        difference, low, high, means = self.confidence_interval(np.asarray(a) - np.asarray(b))
+        pvalue = min(1.0, 2 * min(np.mean(means <= 0), np.mean(means >= 0)))
+        return {"n": len(a), "mean-difference": difference, "ci-low": low, "ci-high": high, "p-value": float(pvalue),
+                "significant": bool(low > 0 or high < 0)}
+
+    def ranking(self, scores):
+        rows = []
+        for (metric, source), group in scores.groupby(['metric', 'source'], sort=False):
+            higher_is_better = METRICS[metric][2]
+            services = []
+            for service, values in group.groupby('service')['value']:
+                mean, low, high, _ = self.confidence_interval(values.to_numpy())
+                services.append({"metric": metric, "source": source, "service": service, "n": len(values),
+                                 "mean": mean, "ci-low": low, "ci-high": high})
+            services.sort(key=lambda row: row["mean"], reverse=higher_is_better)
+            rows.extend({**row, "rank": rank} for rank, row in enumerate(services, start=1))
+        return pd.DataFrame(rows)
+
+    def comparisons(self, scores):
+        rows = []
+        values = scores.pivot_table(index=['metric', 'service', 'segment'], columns='source', values='value', aggfunc='last')
+        # Raw vs adjusted transcriptions of the same segment and service
+        if set(SOURCES) <= set(values.columns):
+            for (metric, service), group in values.groupby(level=['metric', 'service']):
+                paired = group[list(SOURCES)].dropna()
+                if len(paired) > 1:
+                    rows.append({"metric": metric, "comparison": "adjusted-vs-raw", "source": None,
+                                 "a": f"{service}/adjusted", "b": f"{service}/raw",
+                                 **self.paired_test(paired['adjusted'], paired['raw'])})
+
+        # Every pair of services over the segments both of them transcribed
+        for (metric, source), group in scores.groupby(['metric', 'source'], sort=False):
+            by_service = group.pivot_table(index='segment', columns='service', values='value', aggfunc='last')
+            for service_a, service_b in combinations(sorted(by_service.columns), 2):
+                paired = by_service[[service_a, service_b]].dropna()
+                if len(paired) > 1:
+                    rows.append({"metric": metric, "comparison": "service-vs-service", "source": source,
+                                 "a": service_a, "b": service_b,
+                                 **self.paired_test(paired[service_a], paired[service_b])})
+        return pd.DataFrame(rows)
+
+    def run(self):
+        scores = self.load_scores()
+        if scores.empty:
+            print(f"No scores to analyze in {self.folder_evaluations}")
+            return None, None
+
+        ranking, comparisons = self.ranking(scores), self.comparisons(scores)
+        ranking.to_csv(f"{self.folder_evaluations}/analysis-ranking.csv", index=False, encoding='utf-8')
+        comparisons.to_csv(f"{self.folder_evaluations}/analysis-comparisons.csv", index=False, encoding='utf-8')
+        print(self.report(ranking, comparisons))
+        return ranking, comparisons
+
+    def report(self, ranking, comparisons):
+        lines = [f"Service ranking (mean, {self.confidence:.0%} bootstrap CI, {self.resamples} resamples)"]
+        for (metric, source), group in ranking.groupby(['metric', 'source'], sort=False):
+            direction = "higher is better" if METRICS[metric][2] else "lower is better"
+            lines.append(f"  {metric} ({source}, {direction}):")
+            for row in group.to_dict('records'):
+                lines.append(f"    {row['rank']}. {row['service']:<10} {row['mean']:>9.4f}  "
+                             f"[{row['ci-low']:.4f}, {row['ci-high']:.4f}]  n={row['n']}")
+
+        lines.append("Significant differences (paired bootstrap, the CI of the mean difference excludes 0):")
+        significant = comparisons[comparisons['significant']].to_dict('records') if not comparisons.empty else []
+        for row in significant:
+            scope = f" ({row['source']})" if isinstance(row['source'], str) else ""
+            lines.append(f"  {row['metric']}{scope}: {row['a']} - {row['b']} = {row['mean-difference']:+.4f} "
+                         f"[{row['ci-low']:+.4f}, {row['ci-high']:+.4f}], p={row['p-value']:.4f}, n={row['n']}")
+        if not significant:
+            lines.append("  (none)")
+        return "\n".join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals and service ranking over the score reports')
+    parser.add_argument('--folder', default='transcriptions/evaluations', help='Folder with the scores-*.csv reports')
+    parser.add_argument('--resamples', type=int, default=10000)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ScoreAnalysis(args.folder, args.resamples, args.confidence, args.seed).run()
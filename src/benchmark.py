@@ -0,0 +1,185 @@
+import argparse, json, os, random, resource, shutil, struct, tempfile, threading, time, wave
+import numpy as np
+from mock_server import MockAzureServer
+
+WORDS = ("the prisoners were taken to the jail where the magistrates examined their conduct and the history "
+         "of the city records shows that every warden kept a register of inmates and their trials").split()
+
+class MemorySampler:
+    # Peak resident memory of the process while a stage runs, sampled from /proc (tracemalloc would slow the stage down)
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, self._rss())
+            if self._stop.wait(self.interval):
+                break
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # No /proc: fall back to the peak of the whole process
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PipelineBenchmark:
+    # Runs the transcribe, adjust and evaluate stages over a synthetic corpus against the local mock services
+    def __init__(self, files=100, words=40, services=('whisper', 'fast'), folder=None, seed=0, pipeline=False, 
+                 **server_options):
+        self.files = files
+        self.words = words
+        self.services = tuple(services)
+        self.folder = folder or tempfile.mkdtemp(prefix='tayra-benchmark-')
+        self.seed = seed
+        self.pipeline = pipeline
+        self.server = MockAzureServer(seed=seed, **server_options)
+        self.results = []
+
+    def run(self):
+        transcripts = self.create_corpus()
+        self.server.register_transcripts(transcripts)
+        self.server.start()
+        try:
+            self._configure_environment()
+
+            # Imported after the environment points to the mock server, as the clients read it on creation
+            from transcriber import AudioTranscriber
+            from adjuster import TranscriptionAdjuster
+            from evaluator import run_evaluation
+            from pipeline import StreamingPipeline
+            from telemetry import Telemetry
+
+            output_folder = f"{self.folder}/transcriptions"
+            if self.pipeline:
+                # The three stages overlap in one streaming run
+                self._measure('pipeline', self.files * len(self.services),
+                              lambda: StreamingPipeline(output_folder, f"{self.folder}/audios", self.services).run())
+            else:
+                self._measure('transcribe', self.files * len(self.services),
+                              lambda: AudioTranscriber().transcribe_audios(f"{self.folder}/audios", output_folder, self.services))
+                self._measure('adjust', self.files * len(self.services),
+                              lambda: TranscriptionAdjuster(f"{output_folder}/raw").adjust_transcriptions())
+                self._measure('evaluate', self.files * len(self.services) * 2,
+                              lambda: run_evaluation(output_folder))
+
+            Telemetry.get().export('benchmark')
+        finally:
+            self.server.stop()
+        return self.results
+
+    def create_corpus(self):
+        generator = random.Random(self.seed)
+        os.makedirs(f"{self.folder}/audios", exist_ok=True)
+        os.makedirs(f"{self.folder}/transcriptions/groundtruth", exist_ok=True)
+
+        transcripts = {}
+        for index in range(self.files):
+            segment = f"BM{index:06d}"
+            text = " ".join(generator.choice(WORDS) for _ in range(self.words)).capitalize() + "."
+            self._write_wave(f"{self.folder}/audios/{segment}.wav", generator)
+            with open(f"{self.folder}/transcriptions/groundtruth/groundtruth_transcription_{segment}.txt", "w") as f:
+                f.write(text)
+            transcripts[f"{segment}.wav"] = text
+        return transcripts
+
+    def report(self):
+        header = f"{'stage':<12}{'items':>8}{'wall (s)':>10}{'items/s':>10}{'requests':>10}{'errors':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}{'peak RSS MB':>13}"
+        lines = [header, '-' * len(header)]
+        for result in self.results:
+            lines.append(f"{result['stage']:<12}{result['items']:>8}{result['wall-time']:>10.2f}{result['items-per-second']:>10.1f}"
+                         f"{result['requests']:>10}{result['errors']:>8}{result['latency-p50-ms']:>10.1f}"
+                         f"{result['latency-p95-ms']:>10.1f}{result['peak-memory-mb']:>13.1f}")
+        return "\n".join(lines)
+
+    def _measure(self, stage, items, function):
+        self.server.reset_requests()
+        sampler = MemorySampler().start()
+        started = time.perf_counter()
+        try:
+            function()
+        finally:
+            wall_time = time.perf_counter() - started
+            peak = sampler.stop()
+
+        requests = self.server.reset_requests()
+        latencies = np.array([request["latency"] for request in requests]) * 1000 if requests else np.zeros(1)
+        self.results.append({
+            "stage": stage,
+            "items": items,
+            "wall-time": wall_time,
+            "items-per-second": items / wall_time if wall_time else 0.0,
+            "requests": len(requests),
+            "errors": sum(1 for request in requests if request["status"] != 200),
+            "latency-p50-ms": float(np.percentile(latencies, 50)),
+            "latency-p95-ms": float(np.percentile(latencies, 95)),
+            "peak-memory-mb": peak / 1024 / 1024
+        })
+
+    def _configure_environment(self):
+        os.environ.update({
+            "AZURE_OPENAI_ENDPOINT": self.server.url,
+            "AZURE_OPENAI_KEY": "mock",
+            "AZURE_OPENAI_MODEL": "gpt-4o",
+            "AZURE_OPENAI_EMBEDDINGS_MODEL": "text-embedding-ada-002",
+            "AZURE_SPEECH_SERVICES_KEY": "mock",
+            "AZURE_SPEECH_SERVICES_REGION": "mock",
+            "AZURE_FAST_TRANSCRIPTION_ENDPOINT": f"{self.server.url}/speechtotext/transcriptions:transcribe?api-version=2024-05-15-preview",
+            # Measure the requests, not the response cache
+            "AZURE_OPENAI_CACHE_FOLDER": f"{self.folder}/.cache/openai",
+            "AZURE_OPENAI_CACHE_BYPASS": "true",
+            "AZURE_TRANSCRIPTION_CACHE_FOLDER": f"{self.folder}/.cache/transcriptions",
+            "AZURE_TRANSCRIPTION_CACHE_BYPASS": "true"
+        })
+        os.environ.setdefault("TAYRA_TELEMETRY_FOLDER", f"{self.folder}/telemetry")
+
+    def _write_wave(self, path, generator, seconds=0.5, rate=16000):
+        with wave.open(path, "wb") as audio:
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(rate)
+            audio.writeframes(struct.pack(f"<{int(seconds * rate)}h",
+                                          *(generator.randint(-2000, 2000) for _ in range(int(seconds * rate)))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark against local mock Azure services')
+    parser.add_argument('--files', type=int, default=100, help='Number of synthetic audio segments')
+    parser.add_argument('--words', type=int, default=40, help='Words per groundtruth transcription')
+    parser.add_argument('--services', default='whisper,fast',
+                        help='Comma separated transcription services (realtime STT needs the Speech service and is not mocked)')
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true', help='Measure the streaming pipeline instead of the separate stages')
+    parser.add_argument('--folder', help='Working folder (a temporary folder is used and removed by default)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    benchmark = PipelineBenchmark(args.files, args.words, args.services.split(','), args.folder, args.seed, args.pipeline,
+                                  latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                                  error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    try:
+        results = benchmark.run()
+    finally:
+        if not args.folder:
+            shutil.rmtree(benchmark.folder, ignore_errors=True)
+
+    print(benchmark.report())
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
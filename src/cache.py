@@ -0,0 +1,154 @@
+import hashlib, json, os, threading, time
+
+class DiskCache:
+    # Content-addressed on-disk cache: every entry is a JSON file named after the hash of its key
+    # The modification time of an entry is its creation time (for age-based eviction), the access time is its
+    # last use (for size-based eviction, least recently used first)
+    # Share of max_size_bytes that size-based eviction shrinks the cache to
+    LOW_WATER = 0.9
+    # Most time between two sweeps for expired entries
+    SWEEP_SECONDS = 3600.0
+
+    def __init__(self, folder, max_size_bytes=None, max_age_seconds=None, bypass=False):
+        self.folder = folder
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._size_bytes = None
+        self._next_sweep = 0.0
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        self._sweep_expired()
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count(hit=False)
+            return None
+
+        if self.max_age_seconds is not None and time.time() - entry["created"] > self.max_age_seconds:
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        # Mark the entry as used, keeping its creation time
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+        self._count(hit=True)
+        return entry["value"]
+
+    def set(self, key, value):
+        if self.bypass:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        created = time.time()
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": created, "value": value}, f, ensure_ascii=False)
+        os.utime(temp_path, (created, created))
+        # An overwritten entry only changes the size by the difference
+        try:
+            previous_size = os.path.getsize(path)
+        except OSError:
+            previous_size = 0
+        os.replace(temp_path, path)
+
+        if self.max_size_bytes is not None:
+            if self._size_bytes is None:
+                # Walked outside the lock: readers keep going while the size is first computed
+                size_bytes = sum(size for _, size, _, _ in self._entries())
+                with self._lock:
+                    if self._size_bytes is None:
+                        self._size_bytes = size_bytes
+            else:
+                with self._lock:
+                    self._size_bytes += os.path.getsize(path) - previous_size
+            if self._size_bytes > self.max_size_bytes:
+                self.evict()
+        self._sweep_expired()
+
+    def evict(self):
+        # One eviction at a time, down to LOW_WATER of the limit so the next writes don't trigger another walk.
+        # The directory is walked without holding the lock that get() and set() need.
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            now = time.time()
+            total = sum(size for _, size, _, _ in entries)
+            target = self.max_size_bytes * self.LOW_WATER if self.max_size_bytes is not None else None
+            removed = 0
+            for path, size, _, created in entries:
+                expired = self.max_age_seconds is not None and now - created > self.max_age_seconds
+                oversized = target is not None and total - removed > target
+                if not expired and not oversized:
+                    continue
+                self._remove(path)
+                removed += size
+            with self._lock:
+                # Resynchronized with the disk, less what was removed (entries written during the walk are
+                # picked up by the next one)
+                self._size_bytes = total - removed
+        finally:
+            self._evict_lock.release()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit-rate": self.hits / requests if requests else 0.0
+            }
+
+    def _entries(self):
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                if file.endswith(".json"):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, max(stat.st_atime, stat.st_mtime), stat.st_mtime
+
+    def _sweep_expired(self):
+        # Expired entries are removed even when no size limit is set, or when nobody reads them again
+        if self.max_age_seconds is None or time.time() < self._next_sweep:
+            return
+        self._next_sweep = time.time() + min(self.SWEEP_SECONDS, self.max_age_seconds)
+        self.evict()
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,132 @@
+import os, re, wave
+import numpy as np
+
+class AudioChunker:
+    # Splits long WAV files at the quietest point near every max_chunk_seconds, reading the audio in blocks.
+    # Chunks overlap by overlap_seconds so words cut at a split point are heard whole by one of them.
+    def __init__(self, max_chunk_seconds=300.0, overlap_seconds=1.0, search_seconds=None, frame_ms=30, smoothing_ms=300):
+        self.max_chunk_seconds = max_chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        # Split points are searched within the last search_seconds before each max_chunk_seconds boundary
+        self.search_seconds = search_seconds if search_seconds is not None else min(30.0, max_chunk_seconds / 4)
+        self.frame_ms = frame_ms
+        self.smoothing_ms = smoothing_ms
+
+    def is_supported(self, path):
+        try:
+            with wave.open(path, "rb") as audio:
+                return audio.getsampwidth() in (1, 2, 4)
+        except (wave.Error, EOFError, OSError):
+            return False
+
+    def needs_split(self, path):
+        # Supported WAV files longer than one chunk
+        if self.max_chunk_seconds <= 0 or not self.is_supported(path):
+            return False
+        with wave.open(path, "rb") as audio:
+            return audio.getnframes() > self.max_chunk_seconds * audio.getframerate()
+
+    def plan(self, path):
+        # [(start frame, end frame)] of every chunk, without the overlap
+        with wave.open(path, "rb") as audio:
+            rate, total = audio.getframerate(), audio.getnframes()
+            max_frames = int(self.max_chunk_seconds * rate)
+            if max_frames <= 0 or total <= max_frames:
+                return [(0, total)]
+            frame_length = max(1, int(rate * self.frame_ms / 1000))
+            energies = self._frame_energies(audio, frame_length)
+
+        # A pause is a stretch of low energy, not a single quiet frame
+        window = max(1, self.smoothing_ms // self.frame_ms)
+        energies = np.convolve(energies, np.ones(window) / window, mode="same")
+
+        search_frames = int(self.search_seconds * rate)
+        splits = [0]
+        while total - splits[-1] > max_frames:
+            target = splits[-1] + max_frames
+            low = max(splits[-1] + 1, target - search_frames) // frame_length
+            high = max(low + 1, target // frame_length)
+            quietest = low + int(np.argmin(energies[low:high]))
+            splits.append(min(target, quietest * frame_length + frame_length // 2))
+        splits.append(total)
+        return list(zip(splits[:-1], splits[1:]))
+
+    def split(self, path, folder, plan=None):
+        # Writes every chunk (with the overlap before it) to folder, streaming from the source file
+        plan = plan or self.plan(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        chunks = []
+        with wave.open(path, "rb") as audio:
+            rate = audio.getframerate()
+            overlap = int(self.overlap_seconds * rate)
+            block = rate * 10
+            for index, (start, end) in enumerate(plan):
+                first = max(0, start - overlap)
+                chunk_path = f"{folder}/{name}.chunk{index:04d}.wav"
+                audio.setpos(first)
+                with wave.open(chunk_path, "wb") as chunk:
+                    chunk.setparams(audio.getparams())
+                    remaining = end - first
+                    while remaining > 0:
+                        count = min(block, remaining)
+                        data = audio.readframes(count)
+                        if not data:
+                            break
+                        chunk.writeframes(data)
+                        remaining -= count
+                chunks.append({"path": chunk_path, "offset": first / rate, "start": start / rate, "end": end / rate})
+        return chunks
+
+    def stitch_phrases(self, chunks, chunk_phrases):
+        # chunk_phrases holds (offset, duration, text) per chunk, in seconds within the chunk. Offsets are moved to the
+        # timeline of the whole file, and a phrase is kept by the chunk whose own (non overlapping) span holds its middle.
+        phrases = []
+        for chunk, items in zip(chunks, chunk_phrases):
+            for offset, duration, text in items:
+                start = chunk["offset"] + offset
+                if chunk["start"] <= start + duration / 2 < chunk["end"]:
+                    phrases.append((start, text))
+        return phrases
+
+    def stitch_text(self, texts, max_overlap_words=50, min_overlap_words=2):
+        # For services without timestamps: drop the words at the start of a chunk repeating the end of the previous one
+        words = []
+        for text in texts:
+            chunk_words = text.split()
+            overlap = self._overlap(words, chunk_words, max_overlap_words, min_overlap_words)
+            words.extend(chunk_words[overlap:])
+        return " ".join(words)
+
+    def _overlap(self, previous, following, max_overlap_words, min_overlap_words):
+        normalize = lambda word: re.sub(r'[^\w]', '', word.lower())
+        tail = [normalize(word) for word in previous[-max_overlap_words:]]
+        head = [normalize(word) for word in following[:max_overlap_words]]
+        for size in range(min(len(tail), len(head)), min_overlap_words - 1, -1):
+            if tail[-size:] == head[:size]:
+                return size
+        return 0
+
+    def _frame_energies(self, audio, frame_length):
+        # RMS energy of every frame_ms frame, one block of audio in memory at a time
+        channels, width = audio.getnchannels(), audio.getsampwidth()
+        block = frame_length * 1000
+        energies = []
+        audio.rewind()
+        while True:
+            data = audio.readframes(block)
+            if not data:
+                break
+            samples = self._samples(data, width, channels)
+            frames = -(-len(samples) // frame_length)
+            samples = np.pad(samples, (0, frames * frame_length - len(samples)))
+            energies.append(np.sqrt(np.mean(samples.reshape(frames, frame_length) ** 2, axis=1)))
+        return np.concatenate(energies) if energies else np.zeros(1)
+
+    def _samples(self, data, width, channels):
+        if width == 1:
+            samples = np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128
+        elif width == 2:
+            samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+        else:
+            samples = np.frombuffer(data, dtype="<i4").astype(np.float32)
+        return samples.reshape(-1, channels).mean(axis=1)
@@ -0,0 +1,116 @@
+import csv, json, os, threading
+import numpy as np
+import pandas as pd
+from segments import parse_transcription_filename
+from analysis import ks_2samp_batch
+
+class EmbeddingStore:
+    # All embeddings live in one contiguous float32 matrix (raw bytes, memory-mapped on read)
+    # plus a CSV row index of (source, service, segment, filename)
+    INDEX_COLUMNS = ['row', 'source', 'service', 'segment', 'filename']
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.matrix_path = os.path.join(folder, 'embeddings.f32')
+        self.index_path = os.path.join(folder, 'index.csv')
+        self.meta_path = os.path.join(folder, 'meta.json')
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def dimensions(self):
+        return self._meta().get('dimensions')
+
+    @property
+    def config(self):
+        # Fingerprint of the model the rows were embedded with (None for stores written before it was recorded)
+        return self._meta().get('config')
+
+    def reset(self):
+        with self._lock:
+            for path in (self.matrix_path, self.index_path, self.meta_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def append(self, source, files, embeddings, config=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(files):
+            raise ValueError(f"Expected one embedding per file, got {vectors.shape} for {len(files)} files")
+
+        with self._lock:
+            dimensions = self.dimensions
+            if dimensions is None:
+                dimensions = vectors.shape[1]
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'dimensions': dimensions, 'dtype': 'float32', 'config': config}, f)
+            elif dimensions != vectors.shape[1]:
+                raise ValueError(f"Embedding dimensions {vectors.shape[1]} don't match the store ({dimensions})")
+
+            # Drop any partially written row left by an interrupted append before adding new rows
+            row_bytes = dimensions * np.dtype(np.float32).itemsize
+            size = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+            first_row = size // row_bytes
+            with open(self.matrix_path, 'ab') as f:
+                f.truncate(first_row * row_bytes)
+                f.write(vectors.tobytes())
+
+            write_header = not os.path.exists(self.index_path)
+            with open(self.index_path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(self.INDEX_COLUMNS)
+                for row, file in enumerate(files, start=first_row):
+                    service, segment = parse_transcription_filename(file) or ('', '')
+                    writer.writerow([row, source, service, segment, file])
+
+    def _meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return pd.DataFrame(columns=self.INDEX_COLUMNS)
+        index = pd.read_csv(self.index_path, dtype={'segment': str, 'service': str}, keep_default_na=False)
+        # An embedding written again for the same file supersedes the previous row
+        return index.drop_duplicates(subset=['source', 'filename'], keep='last').reset_index(drop=True)
+
+    def load_matrix(self):
+        dimensions = self.dimensions
+        if dimensions is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        rows = os.path.getsize(self.matrix_path) // (dimensions * np.dtype(np.float32).itemsize)
+        return np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(rows, dimensions))
+
+    def groundtruth_pairs(self, groundtruth_source='groundtruth'):
+        # Every (groundtruth row, transcription row) pair that shares a segment id
+        index = self.load_index()
+        groundtruth = index[index['source'] == groundtruth_source]
+        transcriptions = index[index['source'] != groundtruth_source]
+        return groundtruth.merge(transcriptions, on='segment', suffixes=('_groundtruth', ''))
+
+    def ks_test(self, rows_a, rows_b, chunk_size=1024):
+        # Two-sample KS test of the values of every pair of rows, batched over the pairs
+        matrix = self.load_matrix()
+        rows_a, rows_b = np.asarray(rows_a, dtype=np.int64), np.asarray(rows_b, dtype=np.int64)
+        statistics, pvalues = np.empty(len(rows_a)), np.empty(len(rows_a))
+        for start in range(0, len(rows_a), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            statistics[chunk], pvalues[chunk] = ks_2samp_batch(matrix[rows_a[chunk]], matrix[rows_b[chunk]])
+        return statistics, pvalues
+
+    def cosine_similarity(self, rows_a, rows_b, chunk_size=16384):
+        # Row-wise cosine similarity of normalized vectors, computed in chunks to keep memory flat
+        matrix = self.load_matrix()
+        rows_a, rows_b = np.asarray(rows_a, dtype=np.int64), np.asarray(rows_b, dtype=np.int64)
+        scores = np.empty(len(rows_a), dtype=np.float32)
+        for start in range(0, len(rows_a), chunk_size):
+            a = self._normalize(matrix[rows_a[start:start + chunk_size]])
+            b = self._normalize(matrix[rows_b[start:start + chunk_size]])
+            scores[start:start + chunk_size] = np.einsum('ij,ij->i', a, b)
+        return scores
+
+    def _normalize(self, vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
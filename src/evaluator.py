@@ -1,73 +1,136 @@
-import json, os, pandas as pd
-import numpy as np
+import json, os, argparse, pandas as pd
+from itertools import chain
 from dotenv import load_dotenv
 from string import Template
-from scipy import stats
 from helper import AzureOpenAI, GenericTools
+from embedding_store import EmbeddingStore
+from metrics import TranscriptionMetrics
+from manifest import Manifest
+from segments import SegmentIndex, parse_transcription_filename
+from telemetry import Telemetry
+from analysis import ScoreAnalysis
 import prompts as prt
 
 load_dotenv()
 
 class TranscriptionEvaluator:
-    def __init__(self, folder_groundtruth):
+    def __init__(self, folder_groundtruth, max_workers=None, normalizer=None):
         self.folder_groundtruth = folder_groundtruth
         self.azure_openai = AzureOpenAI()
-
-    def _remove_groundtruth_prefix(self, filename):
-        return filename.replace('groundtruth_transcription_', '')
+        self.max_workers = max_workers or self.azure_openai.max_concurrency
+        self.metrics = TranscriptionMetrics(normalizer)
+        self.segments = SegmentIndex(folder_groundtruth)
 
     def calculate_llm_score(self, folder_transcriptions):
-        scores = []
-        for file in os.listdir(self.folder_groundtruth):
-            if file.endswith(".txt"):
-                groundtruth = self._read_file(self.folder_groundtruth, file)
-                transcription_files = self._get_transcription_files(self._remove_groundtruth_prefix(file), 
-                                                                    folder_transcriptions)
-
-                for transcription_file in transcription_files:
-                    transcription = self._read_file(folder_transcriptions, transcription_file)
-                    result = self._get_similarity_score(groundtruth, transcription)
-                    scores.append({
-                        "filename": transcription_file,
-                        "similarity-score": result["similarity-score"],
-                        "reason": result["reason"]
-                    })
-        return scores
-
-    def generate_embeddings(self, folder, suffix):
-        for file in os.listdir(folder):
-            if file.endswith(".txt"):
-                transcription = self._read_file(folder, file)
-                result = self.azure_openai.get_embeddings(transcription)
-                self._save_embeddings(result, folder, suffix, file)
-
-    def calculate_embeddings_similarity_score(self, files_groundtruth, folder_path):
-        scores = []
-        for file in files_groundtruth:            
-            groundtruth = np.load(f"{folder_path}/{file}", allow_pickle=True)
-            ai_transcription_files = self._get_ai_transcription_files(self._remove_groundtruth_prefix(file), 
-                                                                      folder_path)
-
-            for ai_file in ai_transcription_files:
-                ai_transcription = np.load(f"{folder_path}/{ai_file}", allow_pickle=True)
-                similarity_score = self._cosine_similarity(groundtruth, ai_transcription)
-                ks_test = self._kstest_similarity(groundtruth, ai_transcription)
-                scores.append({
-                    "filename": ai_file,
-                    "similarity-score": float(similarity_score),
-                    "ks-test-pvalue": float(ks_test.pvalue),
-                    "ks-test-stats": float(ks_test.statistic)
-                })
-        return scores
+        # Generator: scores are yielded in pair order as soon as they are available
+        pairs = self._get_groundtruth_pairs(folder_transcriptions)
+        yield from GenericTools().iter_concurrently(lambda pair: self.score_pair(folder_transcriptions, *pair), 
+                                                    pairs, self.max_workers)
+
+    def calculate_metrics_score(self, folder_transcriptions):
+        # WER/CER computed locally, no LLM calls involved
+        for groundtruth_file, transcription_file in self._get_groundtruth_pairs(folder_transcriptions):
+            yield self.metrics_pair(folder_transcriptions, groundtruth_file, transcription_file)
+
+    def metrics_pair(self, folder_transcriptions, groundtruth_file, transcription_file):
+        groundtruth = self._read_file(self.folder_groundtruth, groundtruth_file)
+        transcription = self._read_file(folder_transcriptions, transcription_file)
+        return {"filename": transcription_file, **self.metrics.calculate(groundtruth, transcription)}
+
+    def _get_groundtruth_pairs(self, folder_transcriptions):
+        # Re-index the folder once, then match every groundtruth segment exactly
+        self.segments.scan(folder_transcriptions)
+        return self.segments.pairs(folder_transcriptions)
+
+    def score_pair(self, folder_transcriptions, groundtruth_file, transcription_file):
+        groundtruth = self._read_file(self.folder_groundtruth, groundtruth_file)
+        transcription = self._read_file(folder_transcriptions, transcription_file)
+        with Telemetry.get().file('evaluate-llm', f"{os.path.basename(folder_transcriptions)}/{transcription_file}"):
+            result = self._get_similarity_score(groundtruth, transcription)
+        return {
+            "filename": transcription_file,
+            "similarity-score": result["similarity-score"],
+            "reason": result["reason"]
+        }
+
+    def generate_embeddings(self, folder, suffix, force=False):
+        # Embed the new or changed transcriptions of the folder through batched requests
+        folder_base = folder.replace('/' + suffix, '')
+        manifest = Manifest(f"{folder_base}/manifest.jsonl")
+        store = EmbeddingStore(f"{folder_base}/embeddings")
+        config = Manifest.fingerprint(self.azure_openai.embeddings_model)
+
+        # Vectors of different models can't share the store: a new model rebuilds it
+        sources = []
+        if store.config is not None and store.config != config:
+            print("The embeddings model changed: rebuilding the embedding store")
+            sources, force = self._reset_embeddings(store, manifest), True
+
+        files = sorted(file for file in os.listdir(folder) if file.endswith(".txt"))
+        transcriptions = {file: self._read_file(folder, file) for file in files}
+        hashes = {file: GenericTools().hash_text(transcription) for file, transcription in transcriptions.items()}
+        pending = [file for file in files 
+                   if force or not manifest.is_current('embeddings', f"{suffix}/{file}", hashes[file], config)]
+        print(f"Embedding {len(pending)} of {len(files)} {suffix} transcriptions (the rest are up to date)")
+        if not pending:
+            return
+
+        results = self.azure_openai.get_embeddings_batch([transcriptions[file] for file in pending])
+        if store.dimensions is not None and store.dimensions != len(results[0]):
+            # Same deployment name, different vectors (e.g. a redeployed model)
+            print(f"The embeddings have {len(results[0])} dimensions instead of {store.dimensions}: rebuilding the embedding store")
+            sources, pending = self._reset_embeddings(store, manifest), files
+            results = self.azure_openai.get_embeddings_batch([transcriptions[file] for file in pending])
+        store.append(suffix, pending, results, config)
+        for file in pending:
+            manifest.record('embeddings', f"{suffix}/{file}", hashes[file], config, [store.matrix_path, store.index_path])
+
+        # The other sources that were in the store are embedded again with the new model
+        for source in sources:
+            if source != suffix and os.path.isdir(f"{folder_base}/{source}"):
+                self.generate_embeddings(f"{folder_base}/{source}", source)
+
+    def _reset_embeddings(self, store, manifest):
+        # Empties the store and forgets its manifest entries; returns the sources it held
+        sources = list(dict.fromkeys(store.load_index()['source']))
+        store.reset()
+        for key in manifest.keys('embeddings'):
+            manifest.forget('embeddings', key)
+        return sources
+
+    def calculate_embeddings_similarity_score(self, folder_path):
+        store = EmbeddingStore(folder_path)
+        pairs = store.groundtruth_pairs()
+        if pairs.empty:
+            return
+
+        # The store keeps rows of files removed since they were embedded: only score files that still exist
+        folder_base = os.path.dirname(folder_path) or '.'
+        for source in set(pairs['source']):
+            self.segments.scan(f"{folder_base}/{source}")
+        exists = [self.segments.has_file(f"{folder_base}/{pair.source}", pair.filename) 
+                  and self.segments.has_file(self.folder_groundtruth, pair.filename_groundtruth)
+                  for pair in pairs.itertuples(index=False)]
+        # A boolean mask aligned to the frame: an empty list would select (no) columns instead of rows
+        pairs = pairs[pd.Series(exists, index=pairs.index, dtype=bool)]
+        if pairs.empty:
+            return
+        similarity_scores = store.cosine_similarity(pairs['row_groundtruth'], pairs['row'])
+        ks_statistics, ks_pvalues = store.ks_test(pairs['row_groundtruth'], pairs['row'])
+
+        for pair, similarity_score, ks_statistic, ks_pvalue in zip(pairs.itertuples(index=False), similarity_scores, 
+                                                                   ks_statistics, ks_pvalues):
+            yield {
+                "filename": f"{pair.source}-{pair.filename}",
+                "similarity-score": float(similarity_score),
+                "ks-test-pvalue": float(ks_pvalue),
+                "ks-test-stats": float(ks_statistic)
+            }
 
     def _read_file(self, folder, file):
         with open(f"{folder}/{file}", "r") as f:
             return f.read()
 
-    def _get_transcription_files(self, file, folder_transcriptions):
-        return [f_adj for f_adj in os.listdir(folder_transcriptions) 
-                if file.replace('.txt', '') in f_adj]
-
     def _get_similarity_score(self, groundtruth, adjusted_transcription):
         user_prompt = Template(prt.user_prompt_evaluation_similarity_score)
         result = self.azure_openai.send_llm_request(prt.system_prompt_evaluation_similarity_score,
@@ -75,42 +138,72 @@ class TranscriptionEvaluator:
                                                                            adjusted_transcription=adjusted_transcription))
         return json.loads(result)
 
-    def _save_embeddings(self, result, folder, suffix, file):
-        np.array(result).dump(f"{folder.replace('/' + suffix, '')}/embeddings/{suffix}-{file.replace('.txt', '.npy')}")
-
-    def _get_ai_transcription_files(self, file, folder_path):
-        return [f_adj for f_adj in os.listdir(folder_path) 
-                if file.replace('.npy', '').replace('groundtruth-', '') in f_adj 
-                and 'groundtruth' not in f_adj]
-
-    def _cosine_similarity(self, a, b):
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
-
-    def _kstest_similarity(self, a, b):
-        return stats.kstest(a, b)
-    
     def write_scores(self, scores, file_path='evaluations/scores.csv'):
+        # Stream the records to a JSONL file next to the report, then build the CSV report from it
         generic_tools = GenericTools()
-        generic_tools.persist_scores_dataframe(scores, file_path)
+        records_path = f"{os.path.splitext(file_path)[0]}.jsonl"
+        generic_tools.stream_scores(scores, records_path)
+        generic_tools.persist_scores_dataframe(generic_tools.load_scores(records_path), file_path)
+        return records_path
     
-    def evaluate_transcriptions(self, folder):
-        evaluation = []
-        # Loop through transcriptions in the folder
-        for filename in os.listdir(folder):
-            if filename.endswith(".txt"):
-                with open(os.path.join(folder, filename)) as f:
-                    transcription = f.read()
-                    response = AzureOpenAI().send_llm_request(prt.system_prompt_evaluation, 
-                                                              Template(prt.user_prompt_evaluation).substitute(
-                                                                  transcription=transcription))
-                    
-                    # Append the evaluation to the list of evaluations
-                    evaluation.append({
-                        "filename": filename,
-                        "evaluation": json.loads(response)
-                    })
-        
-        return evaluation
+    def evaluate_transcriptions(self, folder, batch_size=None, batch_tokens=None):
+        # Classify the transcriptions in the folder concurrently, yielding them in file order.
+        # Several transcriptions are packed in each request (up to batch_size items within batch_tokens)
+        batch_size = batch_size or int(os.getenv("AZURE_OPENAI_EVALUATION_BATCH_SIZE", "10"))
+        batch_tokens = batch_tokens or int(os.getenv("AZURE_OPENAI_EVALUATION_BATCH_TOKENS", "8000"))
+
+        files = sorted(filename for filename in os.listdir(folder) if filename.endswith(".txt"))
+        if batch_size <= 1:
+            yield from GenericTools().iter_concurrently(lambda filename: self.evaluate_file(folder, filename), 
+                                                        files, self.max_workers)
+            return
+
+        transcriptions = [self._read_file(folder, filename) for filename in files]
+        batches = self.azure_openai.pack_batches(transcriptions, batch_size, batch_tokens)
+        for evaluations in GenericTools().iter_concurrently(
+                lambda batch: self._evaluate_batch(folder, {files[index]: transcriptions[index] for index in batch}), 
+                batches, self.max_workers):
+            yield from evaluations
+
+    def _evaluate_batch(self, folder, transcriptions):
+        if len(transcriptions) == 1:
+            return [self.evaluate_file(folder, filename) for filename in transcriptions]
+
+        try:
+            response = self.azure_openai.send_llm_request(prt.system_prompt_evaluation_batch, 
+                                                          Template(prt.user_prompt_evaluation_batch).substitute(
+                                                              transcriptions=json.dumps(transcriptions, ensure_ascii=False)))
+            results = json.loads(response)
+        except Exception as e:
+            # A rejected batch (too long, filtered content, retries exhausted) is classified one entry at a time
+            print(f"Batched evaluation of {len(transcriptions)} transcriptions failed, falling back to single requests. Reason: {e}")
+            results = {}
+
+        evaluations = []
+        for filename in transcriptions:
+            result = results.get(filename) if isinstance(results, dict) else None
+            if self._is_valid_evaluation(result):
+                evaluations.append({"filename": filename, "evaluation": result})
+            else:
+                # Missing or malformed entries are classified on their own
+                print(f"Batched evaluation returned no valid result for {filename}, falling back to a single request")
+                evaluations.append(self.evaluate_file(folder, filename))
+        return evaluations
+
+    def _is_valid_evaluation(self, result):
+        return (isinstance(result, dict) 
+                and isinstance(result.get("evaluation"), dict) 
+                and isinstance(result["evaluation"].get("category"), str))
+
+    def evaluate_file(self, folder, filename):
+        transcription = self._read_file(folder, filename)
+        response = self.azure_openai.send_llm_request(prt.system_prompt_evaluation, 
+                                                      Template(prt.user_prompt_evaluation).substitute(
+                                                          transcription=transcription))
+        return {
+            "filename": filename,
+            "evaluation": json.loads(response)
+        }
     
     def analyze_evaluation(self, evaluation):
         # Create a DataFrame from the evaluation
@@ -125,53 +218,93 @@ class TranscriptionEvaluator:
         # Rename the columns removing the evaluation prefix
         df.columns = df.columns.str.replace('evaluation.', '')
 
-        # Split the filename into parts using _ as the separator
-        df[['API', 'segment', 'filename']] = df['filename'].str.split('_', expand=True)
+        # Parse the service (API) and the segment id out of the filename
+        parsed = df['filename'].map(parse_transcription_filename)
+        df['API'] = parsed.map(lambda value: value[0] if value else None)
+        df['segment'] = parsed.map(lambda value: value[1] if value else None)
 
-        # Sort the DataFrame by the filename and API columns
-        df = df.sort_values(by=['filename', 'API'])
+        # Sort the DataFrame by the segment and API columns
+        df = df.sort_values(by=['segment', 'API'])
 
         return df
 
-if __name__ == '__main__':
+def run_evaluation(folder='transcriptions', force=False):
     generic_tools = GenericTools()
-    generic_tools.create_clean_folders(['transcriptions/evaluations', 'transcriptions/embeddings'])
+    if force:
+        generic_tools.create_clean_folders([f'{folder}/evaluations', f'{folder}/embeddings'])
+    else:
+        generic_tools.create_folder(f'{folder}/evaluations')
+        generic_tools.create_folder(f'{folder}/embeddings')
+
+    evaluator = TranscriptionEvaluator(f'{folder}/groundtruth')
+    telemetry = Telemetry.get()
 
-    evaluator = TranscriptionEvaluator('transcriptions/groundtruth')
+    # Report missing and orphan segments before spending any request on them
+    evaluator.segments.report(f'{folder}/raw')
+    evaluator.segments.report(f'{folder}/adjusted')
 
     ### LLM Similarity Score ###
-    # Calculate the similarity score (using LLM) between the groundtruth and raw transcriptions
-    scores_raw = evaluator.calculate_llm_score("transcriptions/raw")
+    with telemetry.stage('evaluate-llm'):
+        # Calculate the similarity score (using LLM) between the groundtruth and raw transcriptions
+        scores_raw = evaluator.calculate_llm_score(f"{folder}/raw")
 
-    # Calculate the similarity score (using LLM) between the groundtruth and adjusted transcriptions
-    scores_adjusted = evaluator.calculate_llm_score("transcriptions/adjusted")
-    
-    # Persist the similarity scores
-    evaluator.write_scores(scores_raw, 'transcriptions/evaluations/scores-llm-raw.csv')
-    evaluator.write_scores(scores_adjusted, 'transcriptions/evaluations/scores-llm-adjusted.csv')
+        # Calculate the similarity score (using LLM) between the groundtruth and adjusted transcriptions
+        scores_adjusted = evaluator.calculate_llm_score(f"{folder}/adjusted")
+        
+        # Persist the similarity scores
+        evaluator.write_scores(scores_raw, f'{folder}/evaluations/scores-llm-raw.csv')
+        evaluator.write_scores(scores_adjusted, f'{folder}/evaluations/scores-llm-adjusted.csv')
+    ###################################
+
+    ### WER/CER Metrics ###
+    with telemetry.stage('evaluate-metrics'):
+        evaluator.write_scores(evaluator.calculate_metrics_score(f"{folder}/raw"), 
+                               f'{folder}/evaluations/scores-metrics-raw.csv')
+        evaluator.write_scores(evaluator.calculate_metrics_score(f"{folder}/adjusted"), 
+                               f'{folder}/evaluations/scores-metrics-adjusted.csv')
     ###################################
 
     ### Embeddings Similarity Score ###
-    evaluator.generate_embeddings('transcriptions/groundtruth', 'groundtruth')
-    evaluator.generate_embeddings('transcriptions/raw', 'raw')
-    evaluator.generate_embeddings('transcriptions/adjusted', 'adjusted')
-
-    # Calculate the similarity score (using embeddings) between the groundtruth and raw transcriptions
-    embeddings_files = [f for f in os.listdir("transcriptions/embeddings") 
-                        if f.endswith(".npy") and "groundtruth" in f]
-    scores_embeddings = evaluator.calculate_embeddings_similarity_score(embeddings_files, 
-                                                                        'transcriptions/embeddings')
-
-    # Persist the embeddings similarity scores
-    evaluator.write_scores(scores_embeddings, 'transcriptions/evaluations/scores-embeddings.csv')
+    with telemetry.stage('evaluate-embeddings'):
+        evaluator.generate_embeddings(f'{folder}/groundtruth', 'groundtruth', force=force)
+        evaluator.generate_embeddings(f'{folder}/raw', 'raw', force=force)
+        evaluator.generate_embeddings(f'{folder}/adjusted', 'adjusted', force=force)
+
+        # Calculate the similarity score (using embeddings) between the groundtruth and raw/adjusted transcriptions
+        scores_embeddings = evaluator.calculate_embeddings_similarity_score(f'{folder}/embeddings')
+
+        # Persist the embeddings similarity scores
+        evaluator.write_scores(scores_embeddings, f'{folder}/evaluations/scores-embeddings.csv')
     ###################################
 
     ### Evaluation Analysis ###
-    evaluation_adjusted = evaluator.evaluate_transcriptions("transcriptions/adjusted")
-    evaluation_groundtruth = evaluator.evaluate_transcriptions("transcriptions/groundtruth")
-    evaluation = evaluation_adjusted + evaluation_groundtruth
+    with telemetry.stage('evaluate-classification'):
+        evaluation_adjusted = evaluator.evaluate_transcriptions(f"{folder}/adjusted")
+        evaluation_groundtruth = evaluator.evaluate_transcriptions(f"{folder}/groundtruth")
+        generic_tools.stream_scores(chain(evaluation_adjusted, evaluation_groundtruth), 
+                                    f'{folder}/evaluations/evaluation.jsonl')
+
+        evaluation = generic_tools.load_scores(f'{folder}/evaluations/evaluation.jsonl')
+        # Nothing to classify (no transcriptions, or none matching a segment): the report is left empty
+        df = evaluator.analyze_evaluation(evaluation) if not evaluation.empty else evaluation
+        df.to_csv(f'{folder}/evaluations/evaluation.csv', index=False, encoding='utf-8')
+    ###################################
+
+    ### Confidence Intervals and Ranking ###
+    with telemetry.stage('evaluate-analysis'):
+        ScoreAnalysis(f'{folder}/evaluations').run()
+    ###################################
+
+    return evaluator
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='Clean the outputs and embed every transcription again')
+    args = parser.parse_args()
 
-    df = evaluator.analyze_evaluation(evaluation)
-    df.to_csv('transcriptions/evaluations/evaluation.csv', index=False, encoding='latin-1')
+    evaluator = run_evaluation('transcriptions', force=args.force)
 
+    print(f"Azure OpenAI cache: {evaluator.azure_openai.cache.stats()}")
+    print(f"Azure OpenAI throughput: {evaluator.azure_openai.scheduler_stats()}")
+    Telemetry.get().export('evaluate')
     print("Evaluation completed successfully")
\ No newline at end of file
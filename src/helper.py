@@ -1,6 +1,11 @@
-import os, requests
+import os, json, time, random, hashlib, threading, requests
 import pandas as pd
 import azure.cognitiveservices.speech as speechsdk
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from cache import DiskCache
+from telemetry import Telemetry
 
 class BinaryFileReaderCallback(speechsdk.audio.PullAudioInputStreamCallback):
     def __init__(self, filename: str):
@@ -8,15 +13,8 @@ class BinaryFileReaderCallback(speechsdk.audio.PullAudioInputStreamCallback):
         self._file_h = open(filename, "rb")
 
     def read(self, buffer: memoryview) -> int:
-        try:
-            size = buffer.nbytes
-            frames = self._file_h.read(size)
-
-            buffer[:len(frames)] = frames
-
-            return len(frames)
-        except Exception as ex:
-            raise
+        # Fill the SDK buffer in place instead of allocating a new bytes object on every pull
+        return self._file_h.readinto(buffer) or 0
 
     def close(self) -> None:
         print('closing file')
@@ -26,12 +24,256 @@ class BinaryFileReaderCallback(speechsdk.audio.PullAudioInputStreamCallback):
             print('Exception in `close`: {}'.format(ex))
             raise
 
+class RateLimitScheduler:
+    # Requests-per-minute and tokens-per-minute budgets of one deployment, shared by every thread that calls it.
+    # Throttled (429) and transient (5xx, connection) failures are retried honoring Retry-After, with jittered backoff.
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    WINDOW_SECONDS = 60.0
+
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_retries=8, 
+                 backoff_base=1.0, backoff_max=60.0):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._condition = threading.Condition()
+        self._window = deque()
+        self._paused_until = 0.0
+        self._waiting = 0
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+        self._in_flight = 0
+        self._started = time.monotonic()
+        self._completed = 0
+        self._tokens = 0
+        self._throttled = 0
+        self._retries = 0
+
+    @classmethod
+    def for_deployment(cls, name, requests_per_minute=None, tokens_per_minute=None):
+        with cls._schedulers_lock:
+            if name not in cls._schedulers:
+                cls._schedulers[name] = cls(name, requests_per_minute, tokens_per_minute)
+        return cls._schedulers[name]
+
+    def send(self, request, tokens, service="openai"):
+        # request is a callable performing the HTTP call; tokens is the estimated cost of the call
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            entry = self._acquire(tokens)
+            attempt_started = time.perf_counter()
+            usage = {}
+            # Any exception (not only the retried ones) releases the in-flight slot
+            try:
+                try:
+                    response = request()
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    response, error = None, e
+                else:
+                    error = None
+                    if response.status_code not in self.RETRY_STATUS_CODES:
+                        usage = self._usage(response)
+            finally:
+                self._complete(entry, usage.get("total_tokens", tokens))
+
+            if response is not None and response.status_code not in self.RETRY_STATUS_CODES:
+                self._record(service, response, attempt, attempt_started, started, usage)
+                return response
+
+            if attempt >= self.max_retries:
+                self._record(service, response, attempt, attempt_started, started, error=error)
+                if response is None:
+                    raise error
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            with self._condition:
+                self._retries += 1
+                if response is not None and response.status_code == 429:
+                    # Throttling applies to the whole deployment: hold every caller, not just this one
+                    self._throttled += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            print(f"Retrying {self.name} request in {delay:.1f}s (attempt {attempt + 1}, "
+                  f"{'status ' + str(response.status_code) if response is not None else error})")
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            self._prune(now)
+            elapsed = max(now - self._started, 1e-9)
+            return {
+                "deployment": self.name,
+                "queue-depth": self._waiting,
+                "in-flight": self._in_flight,
+                "requests-last-minute": len(self._window),
+                "tokens-last-minute": sum(tokens for _, tokens in self._window),
+                "requests-per-second": self._completed / elapsed,
+                "tokens-per-second": self._tokens / elapsed,
+                "throttled": self._throttled,
+                "retries": self._retries
+            }
+
+    def _acquire(self, tokens):
+        # Requests are admitted in arrival order: a large request waiting for budget holds back the smaller ones
+        # behind it instead of being starved by them
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._waiting += 1
+            try:
+                while True:
+                    if ticket != self._serving:
+                        self._condition.wait()
+                        continue
+                    now = time.monotonic()
+                    self._prune(now)
+                    wait = max(self._paused_until - now, self._budget_wait(now, tokens))
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+            finally:
+                self._waiting -= 1
+                # Pass the turn on; a caller interrupted while still queued gives its turn up instead of blocking the queue
+                self._abandoned.add(ticket)
+                while self._serving in self._abandoned:
+                    self._abandoned.remove(self._serving)
+                    self._serving += 1
+                self._condition.notify_all()
+            entry = [now, tokens]
+            self._window.append(entry)
+            self._in_flight += 1
+            return entry
+
+    def _complete(self, entry, tokens):
+        with self._condition:
+            # Replace the estimate with the usage reported by the service
+            entry[1] = tokens
+            self._in_flight -= 1
+            self._completed += 1
+            self._tokens += tokens
+            self._condition.notify_all()
+
+    def _budget_wait(self, now, tokens):
+        if not self._window:
+            return 0.0
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            return self._window[0][0] + self.WINDOW_SECONDS - now
+        if self.tokens_per_minute:
+            excess = sum(entry_tokens for _, entry_tokens in self._window) + tokens - self.tokens_per_minute
+            for timestamp, entry_tokens in self._window:
+                if excess <= 0:
+                    break
+                excess -= entry_tokens
+                if excess <= 0:
+                    return timestamp + self.WINDOW_SECONDS - now
+            if excess > 0:
+                # Larger than the limit even alone: sent once the window is empty
+                return self._window[-1][0] + self.WINDOW_SECONDS - now
+        return 0.0
+
+    def _prune(self, now):
+        while self._window and self._window[0][0] <= now - self.WINDOW_SECONDS:
+            self._window.popleft()
+
+    def _retry_delay(self, response, attempt):
+        if response is not None:
+            retry_after_ms = response.headers.get("retry-after-ms")
+            retry_after = response.headers.get("Retry-After")
+            try:
+                if retry_after_ms is not None:
+                    return float(retry_after_ms) / 1000 + random.uniform(0, 0.25)
+                if retry_after is not None:
+                    return float(retry_after) + random.uniform(0, 0.25)
+            except ValueError:
+                pass
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _usage(self, response):
+        try:
+            return response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            return {}
+
+    def _record(self, service, response, retries, attempt_started, started, usage=None, error=None):
+        body = response.request.body if response is not None and response.request is not None else None
+        Telemetry.get().record_call(service, self.name, time.perf_counter() - attempt_started,
+                                    response.status_code if response is not None else None,
+                                    retries=retries,
+                                    bytes_sent=len(body) if body else 0,
+                                    bytes_received=len(response.content) if response is not None else 0,
+                                    usage=usage, error=str(error) if error else None,
+                                    elapsed=time.perf_counter() - started)
+
 class AzureOpenAI():
+    # A single keep-alive connection pool is shared by every instance (and thread), and so is the limit of
+    # requests in flight: nested pools (the windows of a file in each pipeline worker) can't go over it
+    _session = None
+    _slots = None
+    _session_lock = threading.Lock()
+    _cache = None
+    _cache_lock = threading.Lock()
+
     def __init__(self):
         self.api_key = os.getenv("AZURE_OPENAI_KEY")
         self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
         self.model = os.getenv("AZURE_OPENAI_MODEL")
         self.embeddings_model = os.getenv("AZURE_OPENAI_EMBEDDINGS_MODEL")
+        self.max_concurrency = int(os.getenv("AZURE_OPENAI_MAX_CONCURRENCY", "8"))
+        # A stalled connection fails (and is retried) instead of holding its worker and in-flight slot forever
+        self.timeout = float(os.getenv("AZURE_OPENAI_TIMEOUT_SECONDS", "120"))
+        self.session = self._get_session(self.max_concurrency)
+        self.cache = self._get_cache()
+        self.scheduler = RateLimitScheduler.for_deployment(self.model, 
+                                                           self._optional_int("AZURE_OPENAI_RPM"), 
+                                                           self._optional_int("AZURE_OPENAI_TPM"))
+        self.embeddings_scheduler = RateLimitScheduler.for_deployment(self.embeddings_model, 
+                                                                      self._optional_int("AZURE_OPENAI_EMBEDDINGS_RPM"), 
+                                                                      self._optional_int("AZURE_OPENAI_EMBEDDINGS_TPM"))
+
+    def _optional_int(self, name):
+        value = os.getenv(name)
+        return int(value) if value else None
+
+    def _post(self, url, headers, payload):
+        with self._slots:
+            return self.session.post(url, headers=headers, json=payload, timeout=self.timeout)
+
+    def scheduler_stats(self):
+        return [self.scheduler.stats(), self.embeddings_scheduler.stats()]
+
+    @classmethod
+    def _get_session(cls, pool_size):
+        with cls._session_lock:
+            if cls._session is None:
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls._session = session
+                cls._slots = threading.BoundedSemaphore(pool_size)
+        return cls._session
+
+    @classmethod
+    def _get_cache(cls):
+        with cls._cache_lock:
+            if cls._cache is None:
+                max_size_mb = os.getenv("AZURE_OPENAI_CACHE_MAX_SIZE_MB")
+                max_age_days = os.getenv("AZURE_OPENAI_CACHE_MAX_AGE_DAYS")
+                cls._cache = DiskCache(os.getenv("AZURE_OPENAI_CACHE_FOLDER", ".cache/openai"),
+                                       max_size_bytes=int(float(max_size_mb) * 1024 * 1024) if max_size_mb else None,
+                                       max_age_seconds=float(max_age_days) * 86400 if max_age_days else None,
+                                       bypass=os.getenv("AZURE_OPENAI_CACHE_BYPASS", "false").lower() in ("1", "true", "yes"))
+        return cls._cache
 
     def send_llm_request(self, system_prompt, prompt, return_json=True):
         if not self.api_key or not self.endpoint or not self.model:
@@ -69,37 +311,130 @@ class AzureOpenAI():
                     "response_format": { "type": "json_object" } if return_json else { "type": "text" }
                     }
 
-        response = requests.post(f"{self.endpoint}/openai/deployments/{self.model}/chat/completions?api-version=2024-02-15-preview", 
-                                 headers=headers, 
-                                 json=payload)
+        cache_key = DiskCache.make_key("chat", self.endpoint, self.model, system_prompt, prompt,
+                                       payload["temperature"], payload["top_p"], payload["max_tokens"],
+                                       payload["response_format"])
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Azure OpenAI counts max_tokens against the tokens-per-minute quota
+        tokens = self.estimate_tokens(system_prompt) + self.estimate_tokens(prompt) + payload["max_tokens"]
+        url = f"{self.endpoint}/openai/deployments/{self.model}/chat/completions?api-version=2024-02-15-preview"
+        response = self.scheduler.send(lambda: self._post(url, headers, payload), tokens, "openai-chat")
 
         if response.status_code != 200:
             raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
 
-        return response.json()['choices'][0]['message']['content']
+        content = response.json()['choices'][0]['message']['content']
+        self.cache.set(cache_key, content)
+        return content
     
     def get_embeddings(self, text):
+        return self.get_embeddings_batch([text])[0]
+
+    def get_embeddings_batch(self, texts, max_items=None, max_tokens=None):
         if not self.api_key or not self.endpoint or not self.model:
             raise ValueError("API key, endpoint, or model not found in environment variables")
 
+        max_items = max_items or int(os.getenv("AZURE_OPENAI_EMBEDDINGS_BATCH_SIZE", "256"))
+        max_tokens = max_tokens or int(os.getenv("AZURE_OPENAI_EMBEDDINGS_BATCH_TOKENS", "64000"))
+
+        # Only the texts missing from the cache are sent, packed into as few requests as possible
+        embeddings = [None] * len(texts)
+        cache_keys = [DiskCache.make_key("embeddings", self.embeddings_model, text) for text in texts]
+        pending = []
+        for index, cache_key in enumerate(cache_keys):
+            embeddings[index] = self.cache.get(cache_key)
+            if embeddings[index] is None:
+                pending.append(index)
+
+        batches = self.pack_batches([texts[index] for index in pending], max_items, max_tokens)
+        results = GenericTools().run_concurrently(
+            lambda batch: self._request_embeddings([texts[pending[position]] for position in batch]),
+            batches, self.max_concurrency)
+
+        for batch, batch_embeddings in zip(batches, results):
+            for position, embedding in zip(batch, batch_embeddings):
+                index = pending[position]
+                embeddings[index] = embedding
+                self.cache.set(cache_keys[index], embedding)
+
+        return embeddings
+
+    def pack_batches(self, texts, max_items, max_tokens):
+        # Greedily pack consecutive texts (by position) until either the item or the token budget is reached
+        batches, batch, batch_tokens = [], [], 0
+        for position, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(position)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _request_embeddings(self, texts):
         headers = {
             "Content-Type": "application/json",
             "api-key": self.api_key
         }
 
         payload = {
-            "input": text,
+            "input": texts,
             "model": self.embeddings_model
         }
 
-        response = requests.post(f"{self.endpoint}/openai/deployments/{self.embeddings_model}/embeddings?api-version=2024-02-15-preview", 
-                                 headers=headers, 
-                                 json=payload)
+        tokens = sum(self.estimate_tokens(text) for text in texts)
+        url = f"{self.endpoint}/openai/deployments/{self.embeddings_model}/embeddings?api-version=2024-02-15-preview"
+        response = self.embeddings_scheduler.send(lambda: self._post(url, headers, payload), tokens,
+                                                 "openai-embeddings")
+
+        # The service rejects batches that exceed its input limits: split them in half and retry
+        if response.status_code == 400 and len(texts) > 1:
+            middle = len(texts) // 2
+            return self._request_embeddings(texts[:middle]) + self._request_embeddings(texts[middle:])
 
         if response.status_code != 200:
             raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
 
-        return response.json()['data'][0]['embedding']
+        data = sorted(response.json()['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+
+    @staticmethod
+    def estimate_tokens(text):
+        # Rough estimate (~4 characters per token for English text), good enough for request budgeting
+        return len(text) // 4 + 1
+
+class ScoreWriter:
+    # Append-friendly JSONL writer: records reach the disk every flush_every records, so a failed run keeps its partial results
+    def __init__(self, file_path, flush_every=100, append=False):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(file_path, "a" if append else "w", encoding="utf-8")
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class GenericTools:
     def __init__(self):
@@ -124,10 +459,48 @@ class GenericTools:
             self.create_folder(folder)
             self.clean_folder(folder)
 
+    def hash_file(self, file_path, block_size=1024 * 1024):
+        # Streamed in blocks so large audio files are never loaded in memory at once
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def hash_text(self, text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def run_concurrently(self, function, items, max_workers):
+        # Results are returned in the same order as items, regardless of completion order
+        return list(self.iter_concurrently(function, items, max_workers))
+
+    def iter_concurrently(self, function, items, max_workers):
+        # Yields results in the order of items, keeping at most 2 * max_workers calls in flight
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def stream_scores(self, scores, file_path, flush_every=100):
+        # Writes the records to a JSONL file as they are produced and returns the number of records
+        with ScoreWriter(file_path, flush_every) as writer:
+            for score in scores:
+                writer.write(score)
+            return writer.count
+
+    def load_scores(self, file_path):
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            return pd.DataFrame()
+        return pd.read_json(file_path, lines=True, dtype=False, convert_dates=False)
+
     def persist_scores_dataframe(self, scores, file_path):
         df = pd.DataFrame(scores)
         try:
-            df.to_csv(file_path, index=False, encoding='latin-1')
+            df.to_csv(file_path, index=False, encoding='utf-8')
             print(f"Persisted DataFrame to CSV at: {file_path}")
         except Exception as e:
             print(f"Failed to persist DataFrame to CSV. Reason: {e}")
\ No newline at end of file
@@ -0,0 +1,68 @@
+import json, os, threading, time
+from cache import DiskCache
+
+class Manifest:
+    # Append-only journal of stage artifacts: (stage, key) -> input hash, config hash and output paths.
+    # Every artifact is recorded as soon as its outputs are written, so an interrupted run resumes where it stopped.
+    def __init__(self, path):
+        self.path = path
+        self.artifacts = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def fingerprint(*parts):
+        return DiskCache.make_key(*parts)
+
+    def is_current(self, stage, key, inputs, config):
+        entry = self.artifacts.get((stage, key))
+        return (entry is not None
+                and entry['inputs'] == inputs
+                and entry['config'] == config
+                and all(os.path.exists(output) for output in entry['outputs']))
+
+    def record(self, stage, key, inputs, config, outputs):
+        entry = {"stage": stage, "key": key, "inputs": inputs, "config": config,
+                 "outputs": list(outputs), "updated": time.time()}
+        with self._lock:
+            self.artifacts[(stage, key)] = entry
+            self._append(entry)
+
+    def forget(self, stage, key):
+        with self._lock:
+            if self.artifacts.pop((stage, key), None) is not None:
+                self._append({"stage": stage, "key": key, "deleted": True})
+
+    def keys(self, stage):
+        return [key for artifact_stage, key in list(self.artifacts) if artifact_stage == stage]
+
+    def _append(self, entry):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        lines = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run: that artifact will simply be produced again
+                    continue
+                if entry.get("deleted"):
+                    self.artifacts.pop((entry["stage"], entry["key"]), None)
+                else:
+                    self.artifacts[(entry["stage"], entry["key"])] = entry
+
+        # Rewrite the journal when it mostly holds superseded entries
+        if lines > 2 * len(self.artifacts) + 100:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for entry in self.artifacts.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.path)
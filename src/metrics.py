@@ -0,0 +1,123 @@
+import re
+import numpy as np
+
+# Speaker prefixes written by the transcriber (Speaker Guest-1:) and the adjuster (AGENT:, CLIENT:)
+SPEAKER_LABEL = r'^\s*(?:Speaker\s+[\w-]+|AGENT|CLIENT)\s*:'
+
+class TextNormalizer:
+    def __init__(self, lowercase=True, remove_punctuation=True, remove_speaker_labels=True,
+                 speaker_label_pattern=SPEAKER_LABEL):
+        self.lowercase = lowercase
+        self.remove_punctuation = remove_punctuation
+        self.remove_speaker_labels = remove_speaker_labels
+        self.speaker_label = re.compile(speaker_label_pattern, re.MULTILINE | re.IGNORECASE)
+
+    def normalize(self, text):
+        if self.remove_speaker_labels:
+            text = self.speaker_label.sub(' ', text)
+        if self.lowercase:
+            text = text.lower()
+        if self.remove_punctuation:
+            text = re.sub(r'[^\w\s]', ' ', text)
+        return ' '.join(text.split())
+
+class TranscriptionMetrics:
+    def __init__(self, normalizer=None):
+        self.normalizer = normalizer or TextNormalizer()
+
+    def calculate(self, reference, hypothesis):
+        reference = self.normalizer.normalize(reference)
+        hypothesis = self.normalizer.normalize(hypothesis)
+
+        reference_words, hypothesis_words = self._encode_words(reference.split(), hypothesis.split())
+        substitutions, deletions, insertions = self.edit_operations(reference_words, hypothesis_words)
+
+        return {
+            "wer": self._rate(substitutions + deletions + insertions, len(reference_words)),
+            "cer": self._rate(self.edit_distance(reference, hypothesis), len(reference)),
+            "substitutions": substitutions,
+            "deletions": deletions,
+            "insertions": insertions,
+            "reference-words": len(reference_words),
+            "hypothesis-words": len(hypothesis_words)
+        }
+
+    def edit_operations(self, reference, hypothesis):
+        # Levenshtein alignment of two integer sequences, one NumPy pass per reference token.
+        # Substitution/deletion moves are vectorized over the row; insertions along the row are resolved
+        # with a running minimum: D[j] = min over k <= j of (candidate[k] + j - k).
+        # Returns the (substitutions, deletions, insertions) counts of one optimal alignment.
+        n, m = len(reference), len(hypothesis)
+        if n == 0 or m == 0:
+            return 0, n, m
+
+        positions = np.arange(m + 1)
+        cost = positions.copy()
+        substitutions = np.zeros(m + 1, dtype=np.int64)
+        deletions = np.zeros(m + 1, dtype=np.int64)
+        insertions = positions.copy()
+
+        for token in reference:
+            mismatch = (hypothesis != token).astype(np.int64)
+            diagonal = cost[:-1] + mismatch
+            up = cost + 1
+
+            use_diagonal = np.zeros(m + 1, dtype=bool)
+            use_diagonal[1:] = diagonal <= up[1:]
+
+            candidate = up.copy()
+            candidate[1:][use_diagonal[1:]] = diagonal[use_diagonal[1:]]
+            candidate_substitutions = np.where(use_diagonal, np.concatenate(([0], substitutions[:-1] + mismatch)), substitutions)
+            candidate_deletions = np.where(use_diagonal, np.concatenate(([0], deletions[:-1])), deletions + 1)
+            candidate_insertions = np.where(use_diagonal, np.concatenate(([0], insertions[:-1])), insertions)
+
+            shifted = candidate - positions
+            running = np.minimum.accumulate(shifted)
+            source = np.maximum.accumulate(np.where(shifted == running, positions, 0))
+
+            cost = running + positions
+            substitutions = candidate_substitutions[source]
+            deletions = candidate_deletions[source]
+            insertions = candidate_insertions[source] + positions - source
+
+        return int(substitutions[-1]), int(deletions[-1]), int(insertions[-1])
+
+    def edit_distance(self, reference, hypothesis):
+        # Bit-parallel Levenshtein distance (Myers/Hyyrö) with Python integers as bit vectors of any length:
+        # one pass of a few integer operations per hypothesis symbol. Used for CER, where only the distance is needed.
+        m = len(reference)
+        if m == 0:
+            return len(hypothesis)
+
+        peq = {}
+        for index, symbol in enumerate(reference):
+            peq[symbol] = peq.get(symbol, 0) | (1 << index)
+
+        mask = (1 << m) - 1
+        high_bit = 1 << (m - 1)
+        pv, mv, score = mask, 0, m
+        for symbol in hypothesis:
+            eq = peq.get(symbol, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            if ph & high_bit:
+                score += 1
+            elif mh & high_bit:
+                score -= 1
+            ph = (ph << 1) | 1
+            mh = mh << 1
+            pv = (mh | ~(xv | ph)) & mask
+            mv = ph & xv & mask
+        return score
+
+    def _encode_words(self, reference, hypothesis):
+        vocabulary = {}
+        encode = lambda words: np.array([vocabulary.setdefault(word, len(vocabulary)) for word in words], dtype=np.int64)
+        return encode(reference), encode(hypothesis)
+
+    def _rate(self, errors, reference_length):
+        if reference_length == 0:
+            return 0.0 if errors == 0 else 1.0
+        return errors / reference_length
@@ -0,0 +1,217 @@
+import argparse, hashlib, json, math, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+CATEGORIES = ["Legal/Criminal Investigation", "Historical Discussion", "Philosophical/Intellectual Debate"]
+
+CHAT_PATH = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/chat/completions$')
+EMBEDDINGS_PATH = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/embeddings$')
+WHISPER_PATH = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/audio/transcriptions$')
+FAST_PATH = re.compile(r'^/speechtotext/transcriptions:transcribe$')
+
+class MockAzureServer:
+    # Local stand-in for the Azure OpenAI (chat, embeddings, Whisper) and Fast transcription endpoints.
+    # Responses are derived from a hash of the request content, so identical requests get identical answers.
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=50.0, latency_sigma=0.5, error_rate=0.0,
+                 throttle_rate=0.0, retry_after_ms=200, embedding_dimensions=64, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self.embedding_dimensions = embedding_dimensions
+        self.transcripts = {}
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def register_transcripts(self, transcripts):
+        # Audio filename -> reference text returned (with deterministic errors) by Whisper and Fast
+        self.transcripts.update(transcripts)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_requests(self):
+        with self._lock:
+            requests, self.requests = self.requests, []
+        return requests
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately: without this, Nagle's algorithm delays every response
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                started = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                route, status = server._dispatch(self, urlparse(self.path).path, body)
+                with server._lock:
+                    server.requests.append({"route": route, "status": status,
+                                            "latency": time.perf_counter() - started, "bytes": len(body)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _dispatch(self, handler, path, body):
+        for route, pattern, respond in (("chat", CHAT_PATH, self._chat), ("embeddings", EMBEDDINGS_PATH, self._embeddings),
+                                        ("whisper", WHISPER_PATH, self._whisper), ("fast", FAST_PATH, self._fast)):
+            if pattern.match(path):
+                break
+        else:
+            return None, self._send(handler, 404, {"error": {"message": f"Unknown path {path}"}})
+
+        time.sleep(self._latency())
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return route, self._send(handler, 429, {"error": {"code": "429", "message": "Rate limit exceeded"}},
+                                     {"retry-after-ms": str(self.retry_after_ms),
+                                      "Retry-After": str(math.ceil(self.retry_after_ms / 1000))})
+        if draw < self.throttle_rate + self.error_rate:
+            return route, self._send(handler, 500, {"error": {"code": "500", "message": "Injected failure"}})
+
+        try:
+            return route, self._send(handler, 200, respond(body))
+        except Exception as e:
+            return route, self._send(handler, 400, {"error": {"code": "400", "message": str(e)}})
+
+    def _latency(self):
+        if self.latency_ms <= 0:
+            return 0.0
+        with self._lock:
+            # Log-normal latency whose median is latency_ms
+            return self._random.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+
+    def _send(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+        return status
+
+    def _chat(self, body):
+        request = json.loads(body)
+        system_prompt, prompt = [self._message_text(message) for message in request["messages"]]
+        json_response = request.get("response_format", {}).get("type") == "json_object"
+
+        if not json_response:
+            # Adjustment: give back the transcription embedded in the prompt
+            content = prompt.split("Call transcription: ", 1)[-1].rstrip(".")
+        elif "each key is a filename" in system_prompt:
+            items = json.loads(prompt.split("Call transcriptions: ", 1)[-1].rstrip("."))
+            content = json.dumps({filename: {"evaluation": {"category": self._category(text)}}
+                                  for filename, text in items.items()})
+        elif "similarity score" in system_prompt:
+            content = json.dumps({"similarity-score": 50 + self._hash(prompt) % 51, "reason": "Mock similarity score"})
+        else:
+            content = json.dumps({"evaluation": {"category": self._category(prompt)}})
+
+        prompt_tokens = (len(system_prompt) + len(prompt)) // 4 + 1
+        completion_tokens = len(content) // 4 + 1
+        return {
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def _embeddings(self, body):
+        request = json.loads(body)
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        return {
+            "data": [{"index": index, "object": "embedding", "embedding": self._embedding(text)}
+                     for index, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+
+    def _whisper(self, body):
+        return {"text": self._transcript(self._multipart_filename(body))}
+
+    def _fast(self, body):
+        text = self._transcript(self._multipart_filename(body))
+        duration = max(1000, len(text.split()) * 400)
+        return {
+            "durationMilliseconds": duration,
+            "combinedPhrases": [{"text": text}],
+            "phrases": [{"offsetMilliseconds": 0, "durationMilliseconds": duration, "text": text, "locale": "en-US"}]
+        }
+
+    def _embedding(self, text):
+        # Hashed bag of words: transcriptions sharing words get close vectors, as with a real model
+        vector = [0.0] * self.embedding_dimensions
+        for word in re.findall(r'\w+', text.lower()):
+            value = self._hash(word)
+            vector[value % self.embedding_dimensions] += 1.0 if value & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def _transcript(self, filename):
+        text = self.transcripts.get(filename)
+        if text is None:
+            return f"Mock transcription of {filename}."
+        # Drop one word in ten, chosen by hash, to simulate recognition errors
+        words = text.split()
+        return " ".join(word for index, word in enumerate(words) if self._hash(f"{filename}:{index}") % 10)
+
+    def _category(self, text):
+        return CATEGORIES[self._hash(text) % len(CATEGORIES)]
+
+    def _message_text(self, message):
+        content = message["content"]
+        if isinstance(content, list):
+            return "".join(part.get("text", "") for part in content)
+        return content
+
+    def _multipart_filename(self, body):
+        match = re.search(rb'filename="([^"]+)"', body)
+        return match.group(1).decode('utf-8') if match else ""
+
+    def _hash(self, text):
+        return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline stand-in for the Azure OpenAI and Speech endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Median response latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Log-normal spread of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered with a 429')
+    parser.add_argument('--retry-after-ms', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockAzureServer(args.host, args.port, args.latency_ms, args.latency_sigma, args.error_rate,
+                             args.throttle_rate, args.retry_after_ms, seed=args.seed)
+    print(f"Mock Azure services listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
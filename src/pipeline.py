@@ -0,0 +1,202 @@
+import os, argparse, queue, threading, time
+from itertools import chain
+from dotenv import load_dotenv
+from helper import GenericTools, ScoreWriter
+from manifest import Manifest
+from segments import parse_transcription_filename
+from telemetry import Telemetry
+from transcriber import AudioTranscriber, SERVICES
+from adjuster import TranscriptionAdjuster
+from evaluator import TranscriptionEvaluator
+from analysis import ScoreAnalysis
+
+load_dotenv()
+
+# Tells a stage worker that its input is exhausted
+_DONE = object()
+
+REPORTS = ('scores-llm-raw', 'scores-llm-adjusted', 'scores-metrics-raw', 'scores-metrics-adjusted')
+
+def sort_scores(scores):
+    # Records written as they complete, in the (segment, service) order of the batch reports
+    if scores.empty:
+        return scores
+    order = scores['filename'].map(lambda filename: (parse_transcription_filename(filename) or ('', filename))[::-1])
+    return scores.iloc[sorted(range(len(scores)), key=lambda index: order.iat[index])]
+
+class StreamingPipeline:
+    # Transcribe -> adjust -> evaluate, one file at a time through bounded queues: a file is adjusted and scored
+    # as soon as its raw transcription exists, and a full queue holds the stage before it back.
+    # Embeddings and classification, which pack many files per request, run once the stream is drained.
+    def __init__(self, folder='transcriptions', audio_folder='audios', services=SERVICES, transcribe_workers=None,
+                 adjust_workers=None, evaluate_workers=None, queue_size=None):
+        self.folder = folder
+        self.audio_folder = audio_folder
+        self.services = tuple(services)
+        self.transcriber = AudioTranscriber()
+        self.adjuster = TranscriptionAdjuster(f'{folder}/raw')
+        self.evaluator = TranscriptionEvaluator(f'{folder}/groundtruth')
+        self.workers = {
+            'transcribe': transcribe_workers or sum(self.transcriber.service_concurrency[service] for service in self.services),
+            'adjust': adjust_workers or self.adjuster.max_workers,
+            'evaluate': evaluate_workers or self.evaluator.max_workers
+        }
+        self.queue_size = queue_size
+        self.failures = []
+        self.first_result = None
+        self._lock = threading.Lock()
+
+    def run(self, force=False):
+        generic_tools = GenericTools()
+        folders = [f'{self.folder}/raw', f'{self.folder}/adjusted', f'{self.folder}/evaluations', f'{self.folder}/embeddings']
+        if force:
+            generic_tools.create_clean_folders(folders)
+            generic_tools.clean_folder(self.folder)
+        else:
+            for folder in folders:
+                generic_tools.create_folder(folder)
+
+        # The transcriber and the adjuster journal to the same file: share one instance
+        manifest = Manifest(f'{self.folder}/manifest.jsonl')
+        self.adjuster.manifest = manifest
+        audio_files = sorted(file for file in os.listdir(self.audio_folder) if os.path.isfile(f"{self.audio_folder}/{file}"))
+        self.transcriber.remove_orphan_transcriptions(manifest, audio_files)
+        # Adjusted transcriptions of removed audio would still be embedded and classified in _finalize
+        self.adjuster.remove_orphan_adjustments(sorted(file for file in os.listdir(f'{self.folder}/raw') if file.endswith(".txt")))
+
+        self._started = time.perf_counter()
+        writers = {report: ScoreWriter(f'{self.folder}/evaluations/{report}.jsonl') for report in REPORTS}
+        try:
+            with Telemetry.get().stage('pipeline'):
+                self._stream([(audio_file, service) for audio_file in audio_files for service in self.services],
+                             manifest, writers, force)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        with Telemetry.get().stage('pipeline-finalize'):
+            self._finalize(writers, force)
+
+        failures_path = f'{self.folder}/pipeline-failures.csv'
+        if self.failures:
+            generic_tools.persist_scores_dataframe(self.failures, failures_path)
+        elif os.path.exists(failures_path):
+            os.unlink(failures_path)
+        print(f"Pipeline completed in {time.perf_counter() - self._started:.1f}s, first result after "
+              f"{self.first_result or 0:.1f}s, {len(self.failures)} failures")
+        return self.failures
+
+    def _stream(self, tasks, manifest, writers, force):
+        transcribe_queue = queue.Queue()
+        adjust_queue = queue.Queue(maxsize=self.queue_size or 2 * self.workers['adjust'])
+        evaluate_queue = queue.Queue(maxsize=self.queue_size or 2 * self.workers['evaluate'])
+        for task in tasks:
+            transcribe_queue.put(task)
+
+        stages = [
+            ('transcribe', lambda task: self._transcribe(task, manifest, force), transcribe_queue, adjust_queue),
+            ('adjust', lambda file: self._adjust(file, force), adjust_queue, evaluate_queue),
+            ('evaluate', lambda file: self._evaluate(file, writers), evaluate_queue, None)
+        ]
+        threads = {name: [threading.Thread(target=self._work, args=(name, function, inbox, outbox), daemon=True)
+                          for _ in range(self.workers[name])]
+                   for name, function, inbox, outbox in stages}
+        for stage_threads in threads.values():
+            for thread in stage_threads:
+                thread.start()
+
+        # Close the stages in order: once every worker of a stage has returned, its consumers get one marker each
+        for name, _, inbox, _ in stages:
+            for _ in threads[name]:
+                inbox.put(_DONE)
+            for thread in threads[name]:
+                thread.join()
+
+    def _work(self, stage, function, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                return
+            try:
+                result = function(item)
+            except Exception as e:
+                print(f"Pipeline stage {stage} failed for {item}. Reason: {e}")
+                self._fail(stage, item, e)
+                continue
+            if result is not None and outbox is not None:
+                # Blocks while the next stage is behind: backpressure
+                outbox.put(result)
+
+    def _transcribe(self, task, manifest, force):
+        audio_file, service = task
+        audio_hash = self.transcriber.audio_hash(f"{self.audio_folder}/{audio_file}")
+        if force or not manifest.is_current('transcription', f'{service}/{audio_file}', audio_hash,
+                                            self.transcriber.service_config(service)):
+            failure = self.transcriber.transcribe_and_write(self.audio_folder, self.folder, audio_file, service,
+                                                            manifest, audio_hash)
+            if failure:
+                self._fail('transcribe', task, failure['error'])
+                return None
+        return f'{service}_transcription_{audio_file}.txt'
+
+    def _adjust(self, file, force):
+        # The adjust workers are the concurrency of the stage: the windows of a file run one after the other
+        self.adjuster.adjust_file(file, force, max_workers=1)
+        return file
+
+    def _evaluate(self, file, writers):
+        parsed = parse_transcription_filename(file)
+        groundtruth_file = self.evaluator.segments.groundtruth.get(parsed[1]) if parsed else None
+        if groundtruth_file:
+            for source in ('raw', 'adjusted'):
+                folder = f'{self.folder}/{source}'
+                writers[f'scores-llm-{source}'].write(self.evaluator.score_pair(folder, groundtruth_file, file))
+                writers[f'scores-metrics-{source}'].write(self.evaluator.metrics_pair(folder, groundtruth_file, file))
+
+        with self._lock:
+            if self.first_result is None:
+                self.first_result = time.perf_counter() - self._started
+                print(f"First result ({file}) after {self.first_result:.1f}s")
+
+    def _finalize(self, writers, force):
+        generic_tools = GenericTools()
+        for report in REPORTS:
+            generic_tools.persist_scores_dataframe(sort_scores(generic_tools.load_scores(writers[report].file_path)),
+                                                   f'{self.folder}/evaluations/{report}.csv')
+
+        for source in ('groundtruth', 'raw', 'adjusted'):
+            self.evaluator.generate_embeddings(f'{self.folder}/{source}', source, force=force)
+        self.evaluator.write_scores(self.evaluator.calculate_embeddings_similarity_score(f'{self.folder}/embeddings'),
+                                    f'{self.folder}/evaluations/scores-embeddings.csv')
+
+        generic_tools.stream_scores(chain(self.evaluator.evaluate_transcriptions(f'{self.folder}/adjusted'),
+                                          self.evaluator.evaluate_transcriptions(f'{self.folder}/groundtruth')),
+                                    f'{self.folder}/evaluations/evaluation.jsonl')
+        evaluation = generic_tools.load_scores(f'{self.folder}/evaluations/evaluation.jsonl')
+        # A shard can hold no segments at all: it still writes (empty) reports
+        df = self.evaluator.analyze_evaluation(evaluation) if not evaluation.empty else evaluation
+        df.to_csv(f'{self.folder}/evaluations/evaluation.csv', index=False, encoding='utf-8')
+        ScoreAnalysis(f'{self.folder}/evaluations').run()
+
+    def _fail(self, stage, item, error):
+        with self._lock:
+            self.failures.append({"stage": stage, "item": str(item), "error": str(error)})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transcribe, adjust and evaluate every audio file in one streaming run')
+    parser.add_argument('--audio-folder', default='audios')
+    parser.add_argument('--folder', default='transcriptions')
+    parser.add_argument('--services', default=','.join(SERVICES), help='Comma separated transcription services')
+    parser.add_argument('--transcribe-workers', type=int, help='Default: the sum of the service concurrency limits')
+    parser.add_argument('--adjust-workers', type=int, help='Default: AZURE_OPENAI_MAX_CONCURRENCY')
+    parser.add_argument('--evaluate-workers', type=int, help='Default: AZURE_OPENAI_MAX_CONCURRENCY')
+    parser.add_argument('--queue-size', type=int, help='Capacity of the queues between stages (default: twice the consumer workers)')
+    parser.add_argument('--force', action='store_true', help='Clean the outputs and process every audio file again')
+    args = parser.parse_args()
+
+    pipeline = StreamingPipeline(args.folder, args.audio_folder, args.services.split(','), args.transcribe_workers,
+                                 args.adjust_workers, args.evaluate_workers, args.queue_size)
+    pipeline.run(force=args.force)
+    print(f"Azure OpenAI cache: {pipeline.evaluator.azure_openai.cache.stats()}")
+    print(f"Transcription cache: {pipeline.transcriber.cache.stats()}")
+    Telemetry.get().export('pipeline')
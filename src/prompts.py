@@ -9,6 +9,16 @@ Correct any errors you find. \
 Also, replace Speaker Guest information with AGENT (when it is our company assistant) and CLIENT (when it is a customer). \
 Only return the corrected transcription (do not return any other information).'
 
+# Long transcriptions are adjusted in windows of speaker turns; the turns before a window are sent as context only
+user_prompt_transcription_adjuster_window = 'Correct the call transcription by adjusting possible transcription errors \
+and improving the readability of the text. The call transcription is one part of a longer call. \
+The previous part of the call, for context only (do not return it): ${context}. \
+Call transcription: ${transcription}.'
+
+system_prompt_transcription_adjuster_window = system_prompt_transcription_adjuster + ' \
+The transcription is one part of a longer call: only correct and return that part, \
+keeping every speaker turn in the same order. Never return the context given for the previous part of the call.'
+
 ## SIMILARITY SCORE PROMPTS
 user_prompt_evaluation_similarity_score = 'Calculate the similarity between the two given transcriptions. \
 The first was done by a human, the second by an AI service. \
@@ -34,4 +44,17 @@ Return a JSON with the following structure: \
     { "category": "Legal/Criminal Investigation" } }'
 
 user_prompt_evaluation = "Evaluate the following call transcription according to the pre-established criteria. \
-Call transcription: $transcription."
\ No newline at end of file
+Call transcription: $transcription."
+
+system_prompt_evaluation_batch = 'You are an AI assistant that helps to classify content. \
+You will receive a JSON object where each key is a filename and each value is a call transcription. \
+Classify each transcription only in three categories: \
+Category: Legal/Criminal Investigation \
+Category: Historical Discussion \
+Category: Philosophical/Intellectual Debate \
+Return a JSON object with exactly the same keys (one per filename), where each value has the following structure: \
+{ "evaluation": \
+    { "category": "Legal/Criminal Investigation" } }'
+
+user_prompt_evaluation_batch = "Evaluate each of the following call transcriptions according to the pre-established criteria. \
+Call transcriptions: $transcriptions."
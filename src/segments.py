@@ -0,0 +1,91 @@
+import os, re
+
+GROUNDTRUTH_SERVICE = 'groundtruth'
+
+# groundtruth_transcription_{segment}.txt and {service}_transcription_{audio file}.txt
+GROUNDTRUTH_FILENAME = re.compile(r'^groundtruth_transcription_(?P<segment>.+)\.txt$')
+SERVICE_FILENAME = re.compile(r'^(?P<service>[^_]+)_transcription_(?P<audio>.+)\.txt$')
+
+def parse_transcription_filename(filename):
+    # Returns (service, segment) for a transcription file name, or None when the name doesn't follow the layout
+    match = GROUNDTRUTH_FILENAME.match(filename)
+    if match:
+        return GROUNDTRUTH_SERVICE, match.group('segment')
+
+    match = SERVICE_FILENAME.match(filename)
+    if match:
+        return match.group('service'), os.path.splitext(match.group('audio'))[0]
+
+    return None
+
+class SegmentIndex:
+    # Single-pass index of groundtruth and service transcriptions keyed by exact segment id
+    def __init__(self, folder_groundtruth):
+        self.folder_groundtruth = folder_groundtruth
+        self.groundtruth = {}
+        self.folders = {}
+        for filename, (service, segment) in self._scan(folder_groundtruth):
+            if service == GROUNDTRUTH_SERVICE:
+                self.groundtruth[segment] = filename
+
+    def scan(self, folder):
+        # (Re)index a transcription folder: {segment: {service: filename}}
+        segments = {}
+        for filename, (service, segment) in self._scan(folder):
+            segments.setdefault(segment, {})[service] = filename
+        self.folders[folder] = segments
+        return segments
+
+    def transcription_files(self, folder, segment):
+        return self._folder(folder).get(segment, {})
+
+    def has_file(self, folder, filename):
+        parsed = parse_transcription_filename(filename)
+        if parsed is None:
+            return False
+        service, segment = parsed
+        if folder == self.folder_groundtruth:
+            return self.groundtruth.get(segment) == filename
+        return self.transcription_files(folder, segment).get(service) == filename
+
+    def pairs(self, folder):
+        # Sorted (groundtruth file, transcription file) pairs sharing a segment id
+        segments = self._folder(folder)
+        return [(self.groundtruth[segment], segments[segment][service])
+                for segment in sorted(self.groundtruth) if segment in segments
+                for service in sorted(segments[segment])]
+
+    def missing(self, folder):
+        # (segment, service) pairs with a groundtruth but no transcription from a service seen in the folder
+        segments = self._folder(folder)
+        services = sorted({service for files in segments.values() for service in files})
+        return [(segment, service) for segment in sorted(self.groundtruth) for service in services
+                if service not in segments.get(segment, {})]
+
+    def orphans(self, folder):
+        # Transcription files whose segment has no groundtruth
+        segments = self._folder(folder)
+        return sorted(filename for segment, files in segments.items() if segment not in self.groundtruth
+                      for filename in files.values())
+
+    def report(self, folder):
+        missing, orphans = self.missing(folder), self.orphans(folder)
+        print(f"{folder}: {len(self.pairs(folder))} groundtruth pairs, {len(missing)} missing, {len(orphans)} orphan transcriptions")
+        for segment, service in missing:
+            print(f"\tMissing {service} transcription for segment {segment}")
+        for filename in orphans:
+            print(f"\tOrphan transcription without groundtruth: {filename}")
+        return missing, orphans
+
+    def _folder(self, folder):
+        if folder not in self.folders:
+            self.scan(folder)
+        return self.folders[folder]
+
+    def _scan(self, folder):
+        if not os.path.isdir(folder):
+            return
+        for filename in sorted(os.listdir(folder)):
+            parsed = parse_transcription_filename(filename)
+            if parsed is not None:
+                yield filename, parsed
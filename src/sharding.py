@@ -0,0 +1,136 @@
+import os, argparse, hashlib, shutil
+from dotenv import load_dotenv
+from helper import GenericTools
+from segments import SegmentIndex, parse_transcription_filename
+from telemetry import Telemetry
+from transcriber import SERVICES
+from evaluator import TranscriptionEvaluator
+from pipeline import StreamingPipeline, sort_scores
+from analysis import ScoreAnalysis
+
+load_dotenv()
+
+# Every report a shard writes, built from the .jsonl file with the same name
+REPORTS = ('scores-llm-raw', 'scores-llm-adjusted', 'scores-metrics-raw', 'scores-metrics-adjusted', 'scores-embeddings')
+
+def shard_of(segment, shards):
+    # Stable across processes and machines (unlike hash()), so every worker agrees on the partition
+    return int(hashlib.sha256(segment.encode('utf-8')).hexdigest()[:16], 16) % shards
+
+class ShardedRun:
+    # Partitions the segments by hash: each shard is processed by an independent worker (any process or node
+    # sharing the filesystem) in its own folder, with its own manifest, embedding store and reports.
+    def __init__(self, shard, shards, folder='transcriptions', audio_folder='audios'):
+        if not 0 <= shard < shards:
+            raise ValueError(f"Shard {shard} is out of range for {shards} shards")
+        self.shard = shard
+        self.shards = shards
+        self.folder = folder
+        self.audio_folder = audio_folder
+        self.shard_folder = shard_folder(folder, shard, shards)
+
+    def prepare(self):
+        # Links (or copies, where links are not supported) the shard audio files and groundtruth into the shard folder
+        audio_files = sorted(file for file in os.listdir(self.audio_folder) 
+                             if os.path.isfile(f"{self.audio_folder}/{file}")
+                             and shard_of(os.path.splitext(file)[0], self.shards) == self.shard)
+        groundtruth = SegmentIndex(f'{self.folder}/groundtruth').groundtruth
+        groundtruth_files = sorted(filename for segment, filename in groundtruth.items()
+                                   if shard_of(segment, self.shards) == self.shard)
+
+        self._link_files(self.audio_folder, f'{self.shard_folder}/audios', audio_files)
+        self._link_files(f'{self.folder}/groundtruth', f'{self.shard_folder}/groundtruth', groundtruth_files)
+        print(f"Shard {self.shard + 1} of {self.shards}: {len(audio_files)} audio files, {len(groundtruth_files)} groundtruth transcriptions")
+        return audio_files
+
+    def run(self, services=SERVICES, force=False, **workers):
+        self.prepare()
+        pipeline = StreamingPipeline(self.shard_folder, f'{self.shard_folder}/audios', services, **workers)
+        return pipeline.run(force=force)
+
+    def _link_files(self, source, target, files):
+        GenericTools().create_folder(target)
+        # Rebuilt on every run, so a file that left the shard (or the input folder) leaves the shard folder too
+        for file in os.listdir(target):
+            os.unlink(f'{target}/{file}')
+        for file in files:
+            try:
+                os.symlink(os.path.abspath(f'{source}/{file}'), f'{target}/{file}')
+            except OSError:
+                shutil.copy2(f'{source}/{file}', f'{target}/{file}')
+
+def shard_folder(folder, shard, shards):
+    return f'{folder}/shards/{shard}-of-{shards}'
+
+def sort_embedding_scores(scores):
+    # Named {source}-{file}: ordered by segment, then source (in the order they were embedded) and service,
+    # as the groundtruth pairs of a single embedding store
+    if scores.empty:
+        return scores
+    names = scores['filename'].str.split('-', n=1)
+    sources = {source: position for position, source in enumerate(dict.fromkeys(names.str[0]))}
+    order = []
+    for source, file in names:
+        service, segment = parse_transcription_filename(file) or ('', file)
+        order.append((segment, sources[source], service))
+    return scores.iloc[sorted(range(len(scores)), key=lambda index: order[index])]
+
+def merge_shards(folder='transcriptions', shards=1):
+    # Concatenates the records of every shard into the reports of a single run: scores-*.csv and evaluation.csv
+    generic_tools = GenericTools()
+    generic_tools.create_folder(f'{folder}/evaluations')
+    shard_folders = [shard_folder(folder, shard, shards) for shard in range(shards)]
+    missing = [path for path in shard_folders if not os.path.isdir(f'{path}/evaluations')]
+    for path in missing:
+        print(f"Shard {path} has no evaluations yet: its segments are missing from the merged reports")
+
+    for report in REPORTS + ('evaluation',):
+        records_path = f'{folder}/evaluations/{report}.jsonl'
+        with open(records_path, 'w', encoding='utf-8') as merged:
+            for path in shard_folders:
+                if os.path.exists(f'{path}/evaluations/{report}.jsonl'):
+                    with open(f'{path}/evaluations/{report}.jsonl', 'r', encoding='utf-8') as f:
+                        shutil.copyfileobj(f, merged)
+
+        scores = generic_tools.load_scores(records_path)
+        if report == 'evaluation':
+            if not scores.empty:
+                df = TranscriptionEvaluator(f'{folder}/groundtruth').analyze_evaluation(scores)
+                df.to_csv(f'{folder}/evaluations/evaluation.csv', index=False, encoding='utf-8')
+        elif report == 'scores-embeddings':
+            generic_tools.persist_scores_dataframe(sort_embedding_scores(scores), f'{folder}/evaluations/{report}.csv')
+        else:
+            generic_tools.persist_scores_dataframe(sort_scores(scores), f'{folder}/evaluations/{report}.csv')
+
+    # Intervals and ranks over every segment: they cannot be combined from the per shard analyses
+    ScoreAnalysis(f'{folder}/evaluations').run()
+    return missing
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run one shard of the corpus, or merge the reports of every shard')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Transcribe, adjust and evaluate the segments of one shard')
+    run_parser.add_argument('--shard', type=int, required=True, help='Index of the shard, from 0')
+    run_parser.add_argument('--shards', type=int, required=True, help='Total number of shards')
+    run_parser.add_argument('--services', default=','.join(SERVICES), help='Comma separated transcription services')
+    run_parser.add_argument('--transcribe-workers', type=int)
+    run_parser.add_argument('--adjust-workers', type=int)
+    run_parser.add_argument('--evaluate-workers', type=int)
+    run_parser.add_argument('--force', action='store_true', help='Clean the shard outputs and process it again')
+
+    merge_parser = subparsers.add_parser('merge', help='Combine the shard outputs into the evaluation reports')
+    merge_parser.add_argument('--shards', type=int, required=True, help='Total number of shards')
+
+    for subparser in (run_parser, merge_parser):
+        subparser.add_argument('--folder', default='transcriptions')
+        subparser.add_argument('--audio-folder', default='audios')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        ShardedRun(args.shard, args.shards, args.folder, args.audio_folder).run(
+            args.services.split(','), args.force, transcribe_workers=args.transcribe_workers,
+            adjust_workers=args.adjust_workers, evaluate_workers=args.evaluate_workers)
+        Telemetry.get().export(f'shard-{args.shard}-of-{args.shards}')
+    else:
+        merge_shards(args.folder, args.shards)
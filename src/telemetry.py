@@ -0,0 +1,145 @@
+import cProfile, json, os, threading, time
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+
+class Telemetry:
+    # Process-wide record of external calls, stage wall times and per-file timings
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, folder=None, profile_stage=None, profiler=None):
+        self.folder = folder or os.getenv("TAYRA_TELEMETRY_FOLDER", "transcriptions/telemetry")
+        self.profile_stage = profile_stage or os.getenv("TAYRA_PROFILE_STAGE")
+        self.profiler = profiler or os.getenv("TAYRA_PROFILER", "cprofile")
+        self.records = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+        return cls._instance
+
+    def record_call(self, service, deployment, latency, status, retries=0, bytes_sent=0, bytes_received=0,
+                    usage=None, error=None, elapsed=None):
+        # latency is the final attempt; elapsed also covers retries and rate limit waits
+        usage = usage or {}
+        self._append({
+            "type": "call",
+            "service": service,
+            "deployment": deployment,
+            "latency": latency,
+            "elapsed": latency if elapsed is None else elapsed,
+            "status": status,
+            "retries": retries,
+            "bytes-sent": bytes_sent,
+            "bytes-received": bytes_received,
+            "prompt-tokens": usage.get("prompt_tokens", 0),
+            "completion-tokens": usage.get("completion_tokens", 0),
+            "total-tokens": usage.get("total_tokens", 0),
+            "error": error
+        })
+
+    @contextmanager
+    def stage(self, name):
+        profiler = self._start_profiler() if name == self.profile_stage else None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._append({"type": "stage", "stage": name, "wall-time": time.perf_counter() - started})
+            if profiler is not None:
+                self._stop_profiler(profiler, name)
+
+    @contextmanager
+    def file(self, stage, filename):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._append({"type": "file", "stage": stage, "filename": filename, "wall-time": time.perf_counter() - started})
+
+    def summary(self):
+        with self._lock:
+            records = pd.DataFrame(self.records)
+        calls, stages = pd.DataFrame(), pd.DataFrame()
+        if records.empty:
+            return calls, stages
+
+        records_calls = records[records["type"] == "call"]
+        if not records_calls.empty:
+            calls = records_calls.groupby(["service", "deployment"], dropna=False).agg(
+                calls=("latency", "size"),
+                errors=("status", lambda status: int((status != 200).sum())),
+                retries=("retries", "sum"),
+                latency_p50_ms=("latency", lambda latency: np.percentile(latency, 50) * 1000),
+                latency_p95_ms=("latency", lambda latency: np.percentile(latency, 95) * 1000),
+                elapsed_p95_ms=("elapsed", lambda elapsed: np.percentile(elapsed, 95) * 1000),
+                prompt_tokens=("prompt-tokens", "sum"),
+                completion_tokens=("completion-tokens", "sum"),
+                bytes_sent=("bytes-sent", "sum"),
+                bytes_received=("bytes-received", "sum")).reset_index()
+            # Calls share the frame with stage and file records, whose missing columns turn the counters into floats
+            counters = ["retries", "prompt_tokens", "completion_tokens", "bytes_sent", "bytes_received"]
+            calls[counters] = calls[counters].astype(int)
+
+        # Stages running inside a wider one (the streaming pipeline) only have file records
+        records_stages = records[records["type"] == "stage"]
+        records_files = records[records["type"] == "file"]
+        if not records_stages.empty:
+            stages = records_stages.groupby("stage", sort=False).agg(wall_time=("wall-time", "sum")).reset_index()
+        if not records_files.empty:
+            files = records_files.groupby("stage", sort=False).agg(
+                files=("wall-time", "size"),
+                file_p50_s=("wall-time", lambda wall_time: np.percentile(wall_time, 50)),
+                file_p95_s=("wall-time", lambda wall_time: np.percentile(wall_time, 95))).reset_index()
+            stages = stages.merge(files, on="stage", how="outer", sort=False) if not stages.empty else files
+            stages["files"] = stages["files"].fillna(0).astype(int)
+        return calls, stages
+
+    def export(self, name):
+        # Writes every record to {folder}/{name}.jsonl, the summaries to CSV, and prints the summary tables
+        os.makedirs(self.folder, exist_ok=True)
+        with self._lock:
+            records = list(self.records)
+        with open(f"{self.folder}/{name}.jsonl", "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        calls, stages = self.summary()
+        calls.to_csv(f"{self.folder}/{name}-calls.csv", index=False, encoding="utf-8")
+        stages.to_csv(f"{self.folder}/{name}-stages.csv", index=False, encoding="utf-8")
+
+        print("External calls:")
+        print(calls.to_string(index=False) if not calls.empty else "\t(none)")
+        print("Stages:")
+        print(stages.to_string(index=False) if not stages.empty else "\t(none)")
+
+    def _append(self, record):
+        record["timestamp"] = time.time()
+        with self._lock:
+            self.records.append(record)
+
+    def _start_profiler(self):
+        # Both profilers observe the thread that runs the stage: lower the stage concurrency to see the worker code
+        if self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler()
+        else:
+            profiler = cProfile.Profile()
+        profiler.enable() if isinstance(profiler, cProfile.Profile) else profiler.start()
+        return profiler
+
+    def _stop_profiler(self, profiler, name):
+        os.makedirs(self.folder, exist_ok=True)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(f"{self.folder}/profile-{name}.prof")
+            print(f"Profile of stage {name} written to {self.folder}/profile-{name}.prof")
+        else:
+            profiler.stop()
+            with open(f"{self.folder}/profile-{name}.html", "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+            print(f"Profile of stage {name} written to {self.folder}/profile-{name}.html")
@@ -1,32 +1,65 @@
 import os
+import argparse
+import threading
 import time
+import tempfile
 import requests
 import azure.cognitiveservices.speech as speechsdk
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 from helper import BinaryFileReaderCallback, GenericTools
+from chunker import AudioChunker
+from cache import DiskCache
+from manifest import Manifest
+from telemetry import Telemetry
 from string import Template
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+SERVICES = ('stt', 'whisper', 'fast')
 
 class AudioTranscriber:
     def __init__(self):
         load_dotenv()
         self.subscription_key = os.getenv('AZURE_SPEECH_SERVICES_KEY')
         self.region = os.getenv('AZURE_SPEECH_SERVICES_REGION')
-        self.transcriptions = []
+        self.service_concurrency = {
+            'stt': int(os.getenv('AZURE_STT_MAX_SESSIONS', '4')),
+            'whisper': int(os.getenv('AZURE_WHISPER_MAX_CONCURRENCY', '4')),
+            'fast': int(os.getenv('AZURE_FAST_TRANSCRIPTION_MAX_CONCURRENCY', '4'))
+        }
+        # Caps the requests in flight per service, including the chunks of long audio files sent in parallel
+        self._service_slots = {service: threading.BoundedSemaphore(concurrency) 
+                               for service, concurrency in self.service_concurrency.items()}
+        self.chunker = AudioChunker(float(os.getenv('AZURE_TRANSCRIPTION_CHUNK_SECONDS', '300')),
+                                    float(os.getenv('AZURE_TRANSCRIPTION_CHUNK_OVERLAP_SECONDS', '1')))
+        self.session = requests.Session()
+        self._whisper_client = None
+        self._whisper_client_lock = threading.Lock()
+        max_size_mb = os.getenv('AZURE_TRANSCRIPTION_CACHE_MAX_SIZE_MB')
+        self.cache = DiskCache(os.getenv('AZURE_TRANSCRIPTION_CACHE_FOLDER', '.cache/transcriptions'),
+                               max_size_bytes=int(float(max_size_mb) * 1024 * 1024) if max_size_mb else None,
+                               bypass=os.getenv('AZURE_TRANSCRIPTION_CACHE_BYPASS', 'false').lower() in ('1', 'true', 'yes'))
+        self._cache_locks = {}
+        self._audio_hashes = {}
+        self._lock = threading.Lock()
 
-    def conversation_transcriber_transcribed_cb(self, evt: speechsdk.SpeechRecognitionEventArgs):
+    def conversation_transcriber_transcribed_cb(self, evt: speechsdk.SpeechRecognitionEventArgs, transcriptions):
         print('TRANSCRIBED:')
         if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
             print('\tText={}'.format(evt.result.text))
             print('\tSpeaker ID={}'.format(evt.result.speaker_id))
-            self.transcriptions.append({
+            transcriptions.append({
                 "text": evt.result.text,
                 "speaker": evt.result.speaker_id
             })  # Collect the transcription results with speaker diarization
         elif evt.result.reason == speechsdk.ResultReason.NoMatch:
             print('\tNOMATCH: Speech could not be TRANSCRIBED: {}'.format(evt.result.no_match_details))
 
-    def transcribe_audio_stt(self, audio_file_path, language='en-US'):        
+    def transcribe_audio_stt(self, audio_file_path, language='en-US'):
+        return self._cached('stt', audio_file_path, language, lambda: self._run_stt_session(audio_file_path, language))
+
+    def _run_stt_session(self, audio_file_path, language):
         compressed_format = speechsdk.audio.AudioStreamFormat(compressed_stream_format=speechsdk.AudioStreamContainerFormat.ANY)
         callback = BinaryFileReaderCallback(audio_file_path)
         stream = speechsdk.audio.PullAudioInputStream(stream_format=compressed_format, pull_stream_callback=callback)
@@ -37,88 +70,274 @@ class AudioTranscriber:
 
         conversation_transcriber = speechsdk.transcription.ConversationTranscriber(speech_config=speech_config, audio_config=audio_input)
         
-        self.transcriptions = []
-        transcribing_stop = False
+        # Each session gets its own result buffer and completion event, so many sessions can run at once
+        transcriptions = []
+        session_stopped = threading.Event()
+        canceled = []
+
+        def transcribed_cb(evt: speechsdk.SpeechRecognitionEventArgs):
+            self.conversation_transcriber_transcribed_cb(evt, transcriptions)
 
         def stop_cb(evt: speechsdk.SessionEventArgs):
             print('CLOSING on {}'.format(evt))
-            nonlocal transcribing_stop
-            transcribing_stop = True
+            session_stopped.set()
 
-        conversation_transcriber.transcribed.connect(self.conversation_transcriber_transcribed_cb)    
+        def canceled_cb(evt: speechsdk.SessionEventArgs):
+            # The end of the audio stream also cancels the session: only errors make the result incomplete
+            details = getattr(evt, 'cancellation_details', None)
+            if details is not None and details.reason == speechsdk.CancellationReason.Error:
+                canceled.append(details.error_details)
+            stop_cb(evt)
+
+        conversation_transcriber.transcribed.connect(transcribed_cb)    
         conversation_transcriber.session_stopped.connect(stop_cb)
-        conversation_transcriber.canceled.connect(stop_cb)
+        conversation_transcriber.canceled.connect(canceled_cb)
+
+        # The per-service cap holds for every caller, not only for the executors of transcribe_audios
+        with self._service_slots['stt']:
+            started = time.perf_counter()
+            conversation_transcriber.start_transcribing_async().get()
+
+            session_stopped.wait()
 
-        conversation_transcriber.start_transcribing_async()
+            conversation_transcriber.stop_transcribing_async().get()
+        Telemetry.get().record_call('stt', self.region, time.perf_counter() - started, None if canceled else 200,
+                                    bytes_sent=os.path.getsize(audio_file_path),
+                                    bytes_received=sum(len(transcription['text']) for transcription in transcriptions),
+                                    error=str(canceled[0]) if canceled else None)
 
-        while not transcribing_stop:
-            time.sleep(.5)
+        if canceled:
+            # A partial transcription is a failure: it is neither written nor recorded, so the next run retries it
+            raise Exception(f"STT session for {audio_file_path} was canceled: {canceled[0]}")
+        return transcriptions
 
-        conversation_transcriber.stop_transcribing_async()
+    def _get_whisper_client(self):
+        with self._whisper_client_lock:
+            if self._whisper_client is None:
+                self._whisper_client = AzureOpenAI(
+                    api_key=os.getenv("AZURE_OPENAI_KEY"),  
+                    api_version="2024-02-01",
+                    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+                )
+        return self._whisper_client
 
-        return self.transcriptions
+    def transcribe_audio_whisper(self, audio_file_path):
+        return self._cached('whisper', audio_file_path, None, lambda: self._request_whisper(audio_file_path))
 
-    def transcribe_audio_whisper(self, audio_file_path):       
-        client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_KEY"),  
-            api_version="2024-02-01",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+    def _request_whisper(self, audio_file_path):       
+        client = self._get_whisper_client()
         
         deployment_id = "whisper" 
         
-        result = client.audio.transcriptions.create(
-            file=open(audio_file_path, "rb"),            
-            model=deployment_id
-        )
-        
+        started = time.perf_counter()
+        try:
+            with self._service_slots['whisper'], open(audio_file_path, "rb") as audio:
+                result = client.audio.transcriptions.create(
+                    file=audio,            
+                    model=deployment_id
+                )
+        except Exception as e:
+            Telemetry.get().record_call('whisper', deployment_id, time.perf_counter() - started, 
+                                        getattr(e, 'status_code', None), bytes_sent=os.path.getsize(audio_file_path), 
+                                        error=str(e))
+            raise
+
+        Telemetry.get().record_call('whisper', deployment_id, time.perf_counter() - started, 200,
+                                    bytes_sent=os.path.getsize(audio_file_path), bytes_received=len(result.text))
         return result.text
 
     def transcribe_audio_fast(self, audio_file_path, language='en-US'):
+        return self._cached('fast', audio_file_path, language, 
+                            lambda: self._request_fast(audio_file_path, language)['combinedPhrases'][0]['text'])
+
+    def _request_fast(self, audio_file_path, language='en-US'):
         config = Template('{"locales":["$language"], "profanityFilterMode": "None"}')
         
         url = os.getenv('AZURE_FAST_TRANSCRIPTION_ENDPOINT')
         payload = {'definition': config.substitute(language=language)}
-        files = [('audio', (os.path.basename(audio_file_path), open(audio_file_path, 'rb'), 'audio/mpeg'))]
         headers = {
             'Ocp-Apim-Subscription-Key': os.getenv('AZURE_SPEECH_SERVICES_KEY'),
             'Accept': 'application/json'
         }
 
-        response = requests.request("POST", url, headers=headers, data=payload, files=files)
-        return response.json()['combinedPhrases'][0]['text']
+        started = time.perf_counter()
+        try:
+            with self._service_slots['fast'], open(audio_file_path, 'rb') as audio:
+                files = [('audio', (os.path.basename(audio_file_path), audio, 'audio/mpeg'))]
+                response = self.session.request("POST", url, headers=headers, data=payload, files=files)
+        except requests.RequestException as e:
+            Telemetry.get().record_call('fast', urlparse(url).netloc, time.perf_counter() - started, None,
+                                        bytes_sent=os.path.getsize(audio_file_path), error=str(e))
+            raise
+
+        Telemetry.get().record_call('fast', urlparse(url).netloc, time.perf_counter() - started, response.status_code,
+                                    bytes_sent=len(response.request.body or b''), bytes_received=len(response.content),
+                                    error=None if response.status_code == 200 else response.text)
+
+        if response.status_code != 200:
+            raise Exception(f"Request failed with status code {response.status_code}: {response.text}")
+
+        return response.json()
 
-    def transcribe_audios(self, audio_folder='audios', output_folder='transcriptions'):
+    def transcribe_audio_chunked(self, audio_file_path, service, language='en-US'):
+        # Long WAV files are split at pauses and the chunks transcribed in parallel; None when there is a single chunk
+        return self._cached(service, audio_file_path, language if service != 'whisper' else None,
+                            lambda: self._transcribe_chunks(audio_file_path, service, language))
+
+    def _transcribe_chunks(self, audio_file_path, service, language):
+        plan = self.chunker.plan(audio_file_path)
+        if len(plan) < 2:
+            return None
+
+        with tempfile.TemporaryDirectory(prefix='tayra-chunks-') as folder:
+            chunks = self.chunker.split(audio_file_path, folder, plan)
+            print(f"Transcribing {os.path.basename(audio_file_path)} with {service} in {len(chunks)} chunks")
+            if service == 'fast':
+                results = GenericTools().run_concurrently(lambda chunk: self._request_fast(chunk['path'], language), 
+                                                          chunks, self.service_concurrency[service])
+                # Phrase timestamps tell which chunk owns the words heard in an overlap
+                phrases = self.chunker.stitch_phrases(chunks, [[(phrase['offsetMilliseconds'] / 1000, 
+                                                                 phrase['durationMilliseconds'] / 1000, phrase['text'])
+                                                                for phrase in result.get('phrases', [])] 
+                                                               for result in results])
+                return " ".join(text for _, text in phrases)
+
+            texts = GenericTools().run_concurrently(lambda chunk: self._request_whisper(chunk['path']), 
+                                                    chunks, self.service_concurrency[service])
+            return self.chunker.stitch_text(texts)
+
+    def transcribe_file(self, audio_file_path, service, language='en-US'):
+        if service == 'stt':
+            transcriptions_stt = self.transcribe_audio_stt(audio_file_path, language)
+            return "".join(f"Speaker {transcription['speaker']}: {transcription['text']}\n" 
+                           for transcription in transcriptions_stt)
+        if service in ('whisper', 'fast') and self.chunker.needs_split(audio_file_path):
+            transcription = self.transcribe_audio_chunked(audio_file_path, service, language)
+            if transcription is not None:
+                return transcription
+        if service == 'whisper':
+            return self.transcribe_audio_whisper(audio_file_path)
+        if service == 'fast':
+            return self.transcribe_audio_fast(audio_file_path, language)
+        raise ValueError(f"Unknown transcription service: {service}")
+
+    def _cached(self, service, audio_file_path, language, transcribe):
+        # Identical audio under any name is transcribed once per service configuration, also when concurrent workers
+        # get it at the same time. Failed transcriptions raise, so only complete ones are cached.
+        key = DiskCache.make_key('transcription', self.audio_hash(audio_file_path), service, language, 
+                                 self.service_config(service, language or 'en-US'))
+        with self._lock:
+            key_lock = self._cache_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            transcription = transcribe()
+            if transcription is not None:
+                self.cache.set(key, transcription)
+            return transcription
+
+    def audio_hash(self, audio_file_path):
+        # Content hash of the audio, computed once per file version
+        stat = os.stat(audio_file_path)
+        version = (os.path.abspath(audio_file_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if version in self._audio_hashes:
+                return self._audio_hashes[version]
+        audio_hash = GenericTools().hash_file(audio_file_path)
+        with self._lock:
+            self._audio_hashes[version] = audio_hash
+        return audio_hash
+
+    def service_config(self, service, language='en-US'):
+        # Everything that changes a service output for the same audio: a change triggers a new transcription
+        if service == 'stt':
+            return Manifest.fingerprint(service, language, self.region)
+        chunking = (self.chunker.max_chunk_seconds, self.chunker.overlap_seconds)
+        if service == 'whisper':
+            return Manifest.fingerprint(service, os.getenv("AZURE_OPENAI_ENDPOINT"), "whisper", *chunking)
+        return Manifest.fingerprint(service, language, os.getenv('AZURE_FAST_TRANSCRIPTION_ENDPOINT'), *chunking)
+
+    def transcribe_audios(self, audio_folder='audios', output_folder='transcriptions', services=SERVICES, force=False):
+        with Telemetry.get().stage('transcribe'):
+            return self._transcribe_audios(audio_folder, output_folder, services, force)
+
+    def _transcribe_audios(self, audio_folder, output_folder, services, force):
         
         folder_tools = GenericTools()
         
         folder_tools.create_folder(audio_folder)
         folder_tools.create_folder(f'{output_folder}/raw')
         
-        folder_tools.clean_folder(output_folder)
-        folder_tools.clean_folder(f'{output_folder}/raw')
+        if force:
+            folder_tools.clean_folder(output_folder)
+            folder_tools.clean_folder(f'{output_folder}/raw')
+
+        manifest = Manifest(f'{output_folder}/manifest.jsonl')
+        audio_files = sorted(file for file in os.listdir(audio_folder) 
+                             if os.path.isfile(f"{audio_folder}/{file}"))
+        self.remove_orphan_transcriptions(manifest, audio_files)
 
-        for audio_file in os.listdir(audio_folder):
-            audio_file_path = f"{audio_folder}/{audio_file}"
-            
-            transcriptions_stt = self.transcribe_audio_stt(audio_file_path)
-            transcription_whisper = self.transcribe_audio_whisper(audio_file_path)
-            transcription_fast = self.transcribe_audio_fast(audio_file_path)
+        audio_hashes = dict(zip(audio_files, folder_tools.run_concurrently(
+            lambda audio_file: self.audio_hash(f"{audio_folder}/{audio_file}"), audio_files, 8)))
+        tasks = [(audio_file, service) for audio_file in audio_files for service in services
+                 if not manifest.is_current('transcription', f'{service}/{audio_file}', 
+                                            audio_hashes[audio_file], self.service_config(service))]
+        print(f"Transcribing {len(tasks)} of {len(audio_files) * len(services)} file/service pairs (the rest are up to date)")
 
-            with open(f'{output_folder}/raw/stt_transcription_{audio_file}.txt', 'w') as f:
-                for transcription in transcriptions_stt:
-                    f.write(f"Speaker {transcription['speaker']}: {transcription['text']}\n")
+        # Every service gets its own pool, so each one is capped independently while all of them run in parallel
+        executors = {service: ThreadPoolExecutor(max_workers=self.service_concurrency[service]) for service in services}
+        try:
+            futures = [executors[service].submit(self.transcribe_and_write, audio_folder, output_folder, audio_file, 
+                                                 service, manifest, audio_hashes[audio_file])
+                       for audio_file, service in tasks]
+            failures = [failure for failure in (future.result() for future in futures) if failure]
+        finally:
+            for executor in executors.values():
+                executor.shutdown()
 
-            with open(f'{output_folder}/raw/whisper_transcription_{audio_file}.txt', 'w') as f:
-                f.write(transcription_whisper)
+        failures_path = f'{output_folder}/transcription-failures.csv'
+        if failures:
+            folder_tools.persist_scores_dataframe(failures, failures_path)
+        elif os.path.exists(failures_path):
+            os.unlink(failures_path)
 
-            with open(f'{output_folder}/raw/fast_transcription_{audio_file}.txt', 'w') as f:
-                f.write(transcription_fast)
+        return failures
 
-            print(f"Transcription for {audio_file} created successfully")
+    def transcribe_and_write(self, audio_folder, output_folder, audio_file, service, manifest, audio_hash):
+        # A failure is recorded and returned instead of raised so the rest of the batch keeps going
+        output_path = f'{output_folder}/raw/{service}_transcription_{audio_file}.txt'
+        try:
+            with Telemetry.get().file('transcribe', f'{service}/{audio_file}'):
+                transcription = self.transcribe_file(f"{audio_folder}/{audio_file}", service)
+            with open(output_path, 'w') as f:
+                f.write(transcription)
+        except Exception as e:
+            print(f"Failed to transcribe {audio_file} with {service}. Reason: {e}")
+            return {"filename": audio_file, "service": service, "error": str(e)}
+
+        manifest.record('transcription', f'{service}/{audio_file}', audio_hash, self.service_config(service), [output_path])
+        print(f"Transcription for {audio_file} ({service}) created successfully")
+        return None
+
+    def remove_orphan_transcriptions(self, manifest, audio_files):
+        # Drop the outputs of audio files that are no longer in the input folder
+        audio_files = set(audio_files)
+        for key in manifest.keys('transcription'):
+            if key.split('/', 1)[1] not in audio_files:
+                for output in manifest.artifacts[('transcription', key)]['outputs']:
+                    if os.path.exists(output):
+                        os.unlink(output)
+                manifest.forget('transcription', key)
     
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='Clean the outputs and transcribe every audio file again')
+    args = parser.parse_args()
+
     transcriber = AudioTranscriber()
-    transcriber.transcribe_audios()
+    transcriber.transcribe_audios(force=args.force)
+    print(f"Transcription cache: {transcriber.cache.stats()}")
+    Telemetry.get().export('transcribe')